@@ -11,6 +11,8 @@ parser.add_argument('--cfg', type=str, help='args file to create the model.')
 parser.add_argument('--mask', type=str, default=None, help='Path to load the mask, if existis.')
 parser.add_argument('--embbed', action='store_true', help='To load the mask from the same checkpoint of model.')
 parser.add_argument('--device', help='cuda:id or cpu', required=True)
+parser.add_argument('--img_size', type=int, default=416, help='input size to compute the peak activation memory.')
+parser.add_argument('--batch_size', type=int, default=1, help='batch size to compute the peak activation memory.')
 # parser.add_argument('--clever_format', action='store_true')
 args = vars(parser.parse_args())
 
@@ -47,6 +49,8 @@ else:
     sparse = SparseYOLO(model).to(device)
     total_ops, total_params = profile(sparse, (x, ), verbose=True)
 
-print("%s | %s" % ("Params", "FLOPs"))
-print("---|---")
-print("%.2f | %.2f" % (total_params, total_ops ))
\ No newline at end of file
+peak, peak_wo_free = activation_memory(model, args['img_size'], args['batch_size'])
+
+print("%s | %s | %s | %s" % ("Params", "FLOPs", "Peak activation (MB)", "Without freeing (MB)"))
+print("---|---|---|---")
+print("%.2f | %.2f | %.2f | %.2f" % (total_params, total_ops, peak / 1E6, peak_wo_free / 1E6))
\ No newline at end of file
@@ -64,7 +64,7 @@ def train(iteration, best_fitness, prebias, trainloader, validloader, config, sc
         if trainloader.dataset.image_weights:
             w = model.class_weights.cpu().numpy() * (1 - maps) ** 2  # class weights
             image_weights = labels_to_image_weights(trainloader.dataset.labels, nc=nc, class_weights=w)
-            trainloader.dataset.indices = random.choices(range(trainloader.dataset.n), weights=image_weights, k=trainloader.dataset.n)  # rand weighted idx
+            trainloader.sampler.set_epoch(epoch, image_weights)  # seeded weighted draw of the epoch
 
         ###########
         # From CS #
@@ -80,8 +80,11 @@ def train(iteration, best_fitness, prebias, trainloader, validloader, config, sc
         ####################
         for i, (imgs, targets, paths, _) in pbar: 
             ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
-            targets = targets.to(device)
+            imgs, targets = imgs.to(device), targets.to(device)
+            if trainloader.dataset.batch_augment:  # flips and hsv of the whole batch, on device
+                imgs, targets = trainloader.dataset.batch_augment(imgs, targets)
+            else:
+                imgs = imgs.float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
 
             # Plot images with bounding boxes
             if ni < 1:
@@ -185,6 +188,7 @@ def train(iteration, best_fitness, prebias, trainloader, validloader, config, sc
                         'epoch': epoch,
                          'best_fitness': best_fitness,
                          'training_results': f.read(),
+                         'sampler': trainloader.sampler.state_dict() if trainloader.dataset.image_weights else None,
                          'model': model.module.state_dict() if type(
                              model) is nn.parallel.DistributedDataParallel else model.state_dict(),
                          'optimizer': None if final_epoch else optimizer.state_dict()}
@@ -65,10 +65,10 @@ def detect(save_img=False):
     if webcam:
         view_img = True
         torch.backends.cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=img_size)
+        dataset = LoadStreams(source, img_size=img_size, drop=opt.drop, nth=opt.nth)
     else:
         save_img = True
-        dataset = LoadImages(source, img_size=img_size)
+        dataset = LoadImages(source, img_size=img_size, prefetch=opt.prefetch, batch=opt.frame_batch)
 
     # Get names and colors
     names = load_classes(opt.names)
@@ -85,11 +85,12 @@ def detect(save_img=False):
         if img.ndimension() == 3:
             img = img.unsqueeze(0)
 
-        # Inference
-        pred = model(img)[0].float() if half else model(img)[0]
+        # Inference (decoded in float32, rows below conf_thres dropped before NMS)
+        pred = inference(model, img, opt.conf_thres)
 
         # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms,
+                                   topk_per_image=opt.topk_per_image, topk_per_class=opt.topk_per_class, max_det=opt.max_det)
 
         # Apply Classifier
         if classify:
@@ -97,7 +98,7 @@ def detect(save_img=False):
 
         # Process detections
         for i, det in enumerate(pred):  # detections per image
-            if webcam:  # batch_size >= 1
+            if webcam or isinstance(im0s, list):  # batch_size >= 1
                 p, s, im0 = path[i], '%g: ' % i, im0s[i]
             else:
                 p, s, im0 = path, '', im0s
@@ -173,6 +174,13 @@ if __name__ == '__main__':
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
+    parser.add_argument('--topk-per-image', type=int, default=None, help='best candidates per image kept before NMS')
+    parser.add_argument('--topk-per-class', type=int, default=None, help='best candidates per image and class kept before NMS')
+    parser.add_argument('--max-det', type=int, default=None, help='maximum detections per image after NMS')
+    parser.add_argument('--prefetch', type=int, default=4, help='batches decoded ahead in the background, 0 for none')
+    parser.add_argument('--frame-batch', type=int, default=1, help='consecutive video frames per inference batch')
+    parser.add_argument('--drop', type=str, default='latest', help='stream frames kept: latest, nth or queue (all)')
+    parser.add_argument('--nth', type=int, default=4, help='frame interval of --drop nth')
     opt = parser.parse_args()
     print(opt)
 
@@ -148,7 +148,7 @@ def train():
         if trainloader.dataset.image_weights:
             w = student.class_weights.cpu().numpy() * (1 - maps) ** 2  # class weights
             image_weights = labels_to_image_weights(trainloader.dataset.labels, nc=nc, class_weights=w)
-            trainloader.dataset.indices = random.choices(range(trainloader.dataset.n), weights=image_weights, k=trainloader.dataset.n)  # rand weighted idx
+            trainloader.sampler.set_epoch(epoch, image_weights)  # seeded weighted draw of the epoch
 
         mloss = torch.zeros(9).to(device)  # mean losses
         print(('\n' + '%10s' * 13) % ('Epoch', 'gpu_mem', 'GIoU', 'obj', 'cls', 'G_loss', 'D_loss', 'D_x', 'D_g_z1', 'D_g_z2', 'total', 'targets', 'img_size'))
@@ -160,8 +160,11 @@ def train():
             real_data_label = torch.ones(imgs.shape[0], device=device)
             fake_data_label = torch.zeros(imgs.shape[0], device=device)
             ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
-            targets = targets.to(device)
+            imgs, targets = imgs.to(device), targets.to(device)
+            if trainloader.dataset.batch_augment:  # flips and hsv of the whole batch, on device
+                imgs, targets = trainloader.dataset.batch_augment(imgs, targets)
+            else:
+                imgs = imgs.float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
 
             # Plot images with bounding boxes
             if ni < 1:
@@ -327,6 +330,7 @@ def train():
                     'epoch': epoch,
                     'best_fitness': best_fitness,
                     'training_results': f.read(),
+                    'sampler': trainloader.sampler.state_dict() if trainloader.dataset.image_weights else None,
                     'model': student.module.state_dict() if type(student) is nn.parallel.DistributedDataParallel 
                         else student.state_dict(),
                     'D': D_models.state_dict(),
@@ -7,6 +7,7 @@ from copy import deepcopy
 from utils.utils import *
 from collections import OrderedDict
 ONNX_EXPORT = False
+MAX_GRIDS = 64  # grid shapes cached per YOLOLayer (multi-scale and rectangular batches)
 
 
 def create_modules(module_defs, img_size, arc):
@@ -214,6 +215,124 @@ def create_modules(module_defs, img_size, arc):
     return module_list, routs
 
 
+def create_plan(module_defs, soft=False):
+    # Compiles module_defs into a static execution plan of (kind, input layers, keep output, layers to free) per layer
+    plan = []
+    for i, mdef in enumerate(module_defs):
+        mtype, layers = mdef['type'], []
+        if mtype == 'softconv' and soft:
+            kind = 'soft'  # SoftMaskedConv2d needs temperature and ticket
+        elif mtype in ['convolutional', 'multibias', 'multiconv_multibias', 'halfconv', 'softconv', 'inception',
+                       'upsample', 'maxpool', 'PEP', 'EP', 'FCA', 'mobile']:
+            kind = 'module'
+        elif mtype == 'shortcut':  # sum
+            kind = 'shortcut'
+            layers = [i + l if l < 0 else l for l in mdef['from']]  # absolute layer indices
+        elif mtype == 'route':  # concat
+            kind = 'route'
+            layers = [i + l if l < 0 else l for l in mdef['layers']]
+        elif mtype == 'yolo':
+            kind = 'yolo'
+        else:  # reorg3d and unrecognized layers pass x through
+            kind = 'skip'
+        plan.append((kind, layers))
+
+    # Liveness: keep an output only if a later layer reads it, free it right after its last reader
+    last_use = {}  # layer index: index of the last layer reading it
+    for i, (_, layers) in enumerate(plan):
+        for j in layers:
+            last_use[j] = i
+    free = [[] for _ in plan]
+    for j, i in last_use.items():
+        free[i].append(j)
+
+    return [(kind, layers, i in last_use, free[i]) for i, (kind, layers) in enumerate(plan)]
+
+
+def run_plan(self, x, fts_indexes=(), stats=None, raw=False):
+    # Executes self.plan over self.module_list, returns yolo layer outputs and the features at fts_indexes
+    # stats (list) receives the activation bytes held after each layer, with and without liveness freeing
+    # raw returns the yolo layer inputs undecoded, see inference()
+    img_size = x.shape[-2:]
+    fts_indexes = set(fts_indexes)
+    yolo_out, fts, held = [], [], []
+    out = [None] * len(self.plan)  # retained layer outputs
+    for i, (module, (kind, layers, keep, free)) in enumerate(zip(self.module_list, self.plan)):
+        if kind == 'module':
+            x = module(x)
+        elif kind == 'soft':
+            x = module[1:](module[0](x, self.temp, self.ticket))
+        elif kind == 'shortcut':
+            x = module(x, [out[j] for j in layers])  # weightedFeatureFusion()
+        elif kind == 'route':
+            if len(layers) == 1:
+                x = out[layers[0]]
+            else:
+                try:
+                    x = torch.cat([out[j] for j in layers], 1)
+                except:  # apply stride 2 for darknet reorg layer
+                    out[layers[1]] = F.interpolate(out[layers[1]], scale_factor=[0.5, 0.5])
+                    x = torch.cat([out[j] for j in layers], 1)
+        elif kind == 'yolo':
+            yolo_out.append(x if raw else module(x, img_size))
+
+        if keep:
+            out[i] = x
+        for j in free:  # i was the last reader of j
+            out[j] = None
+        if i in fts_indexes:
+            fts.append(x)
+
+        if stats is not None:
+            if keep:
+                held.append(x)
+            stats.append((tensor_bytes([x] + [t for t in out if t is not None]), tensor_bytes([x] + held)))
+
+    return yolo_out, fts
+
+
+def tensor_bytes(tensors):
+    # Returns the bytes of the distinct storages behind tensors (route outputs may alias earlier layers)
+    return sum({t.data_ptr(): t.numel() * t.element_size() for t in tensors}.values())
+
+
+@torch.no_grad()
+def activation_memory(model, img_size=(416, 416), batch_size=1):
+    # Returns peak bytes of activations held between layers, with and without liveness freeing
+    img_size = (img_size, img_size) if isinstance(img_size, int) else tuple(img_size)
+    p = next(model.parameters())
+    training = model.training
+    model.eval()
+    stats = []
+    run_plan(model, torch.zeros((batch_size, 3) + img_size, dtype=p.dtype, device=p.device), stats=stats)
+    model.train(training)
+    return tuple(max(x) for x in zip(*stats))
+
+
+@torch.no_grad()
+def inference(model, x, conf_thres=None):
+    # Inference-only forward: decodes all yolo layers straight into one float32 buffer, without the clones and
+    # raw training outputs of forward(). With conf_thres, returns per image only the rows with obj > conf_thres
+    p, _ = run_plan(model, x, raw=True)
+    layers = [model.module_list[i] for i in model.yolo_layers]
+    n = [m.na * pi.shape[2] * pi.shape[3] for m, pi in zip(layers, p)]  # outputs per yolo layer
+    shape = (x.shape[0], sum(n), layers[0].no)
+    io = getattr(model, 'io', None)
+    if conf_thres is None or io is None or io.shape != shape or io.device != x.device:
+        io = torch.empty(shape, device=x.device)
+        if conf_thres is not None:  # rows are copied out below, so the buffer can be reused
+            model.io = io
+
+    i = 0
+    for m, pi, ni in zip(layers, p, n):
+        m.decode(pi, x.shape[-2:], io[:, i:i + ni])
+        i += ni
+
+    if conf_thres is None:
+        return io
+    return [xi[xi[:, 4] > conf_thres] for xi in io]
+
+
 class YOLOLayer(nn.Module):
     def __init__(self, anchors, nc, img_size, yolo_index, arc):
         super(YOLOLayer, self).__init__()
@@ -226,6 +345,8 @@ class YOLOLayer(nn.Module):
         self.nx = 0  # initialize number of x gridpoints
         self.ny = 0  # initialize number of y gridpoints
         self.arc = arc
+        self.grid_key = None  # (nx, ny, img_size, device, dtype) of the current grids
+        self.grids = OrderedDict()  # LRU cache of previously built grids, see load_grids()
 
         if ONNX_EXPORT:
             stride = [32, 16, 8][yolo_index]  # stride of this layer
@@ -238,8 +359,9 @@ class YOLOLayer(nn.Module):
             bs = 1  # batch size
         else:
             bs, _, ny, nx = p.shape  # bs, 255, 13, 13
-            if (self.nx, self.ny) != (nx, ny):
-                create_grids(self, img_size, (nx, ny), p.device, p.dtype)
+            key = (nx, ny, max(img_size), p.device, p.dtype)
+            if self.grid_key != key:
+                load_grids(self, key, img_size)
 
         # p.view(bs, 255, 13, 13) -- > (bs, 3, 13, 13, 85)  # (bs, anchors, grid, grid, classes + xywh)
         p = p.view(bs, self.na, self.no, self.ny, self.nx).permute(0, 1, 3, 4, 2).contiguous()  # prediction
@@ -284,6 +406,30 @@ class YOLOLayer(nn.Module):
             # reshape from [1, 3, 13, 13, 85] to [1, 507, 85]
             return io.view(bs, -1, self.no), p
 
+    def decode(self, p, img_size, io):
+        # Decodes p (bs, 255, 13, 13) in place into io (bs, 507, 85), same as the inference branch of forward()
+        bs, _, ny, nx = p.shape
+        key = (nx, ny, max(img_size), p.device, p.dtype)
+        if self.grid_key != key:
+            load_grids(self, key, img_size)
+
+        io = io.view(bs, self.na, ny, nx, self.no)
+        io.copy_(p.view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2))
+        io[..., :2].sigmoid_().add_(self.grid_xy).mul_(self.stride)  # xy
+        io[..., 2:4].exp_().mul_(self.anchor_wh).mul_(self.stride)  # wh
+
+        if 'default' in self.arc:  # seperate obj and cls
+            io[..., 4:].sigmoid_()
+        elif 'BCE' in self.arc:  # unified BCE (80 classes)
+            io[..., 5:].sigmoid_()
+            io[..., 4] = 1
+        elif 'CE' in self.arc:  # unified CE (1 background + 80 classes)
+            io[..., 4:] = F.softmax(io[..., 4:], dim=4)
+            io[..., 4] = 1
+
+        if self.nc == 1:
+            io[..., 5] = 1  # single-class model https://github.com/ultralytics/yolov3/issues/235
+
 
 class Darknet(nn.Module):
     # YOLOv3 object detection model
@@ -293,6 +439,7 @@ class Darknet(nn.Module):
 
         self.module_defs = parse_model_cfg(cfg)
         self.module_list, self.routs = create_modules(self.module_defs, img_size, arc)
+        self.plan = create_plan(self.module_defs)
         self.yolo_layers = get_yolo_layers(self)
 
         # Darknet Header https://github.com/AlexeyAB/darknet/issues/2914#issuecomment-496675346
@@ -300,51 +447,7 @@ class Darknet(nn.Module):
         self.seen = np.array([0], dtype=np.int64)  # (int64) number of images seen during training
 
     def forward(self, x, fts_indexes=[], verbose=False):
-        img_size = x.shape[-2:]
-        yolo_out, out, fts = [], [], []
-        verbose = False
-        if verbose:
-            str = ''
-            print('0', x.shape)
-
-        for i, (mdef, module) in enumerate(zip(self.module_defs, self.module_list)):
-            mtype = mdef['type']
-            if mtype in [
-                    'convolutional', 'multibias', 'multiconv_multibias', 
-                    'halfconv', 'inception', 'upsample', 'maxpool',
-                    'PEP', 'EP', 'FCA', 'mobile'
-                ]:
-                x = module(x)
-            elif mtype == 'shortcut':  # sum
-                if verbose:
-                    l = [i - 1] + module.layers  # layers
-                    s = [list(x.shape)] + [list(out[i].shape) for i in module.layers]  # shapes
-                    str = ' >> ' + ' + '.join(['layer %g %s' % x for x in zip(l, s)])
-                x = module(x, out)  # weightedFeatureFusion()
-            elif mtype == 'route': # concat
-                layers = mdef['layers']
-                if verbose:
-                    l = [i - 1] + layers  # layers
-                    s = [list(x.shape)] + [list(out[i].shape) for i in layers]  # shapes
-                    str = ' >> ' + ' + '.join(['layer %g %s' % x for x in zip(l, s)])
-                if len(layers) == 1:
-                    x = out[layers[0]]
-                else:
-                    try:
-                        x = torch.cat([out[i] for i in layers], 1)
-                    except:  # apply stride 2 for darknet reorg layer
-                        out[layers[1]] = F.interpolate(out[layers[1]], scale_factor=[0.5, 0.5])
-                        x = torch.cat([out[i] for i in layers], 1)
-                    # print(''), [print(out[i].shape) for i in layers], print(x.shape)
-            elif mtype == 'yolo':
-                yolo_out.append(module(x, img_size))
-            out.append(x if i in self.routs else [])
-
-            if i in fts_indexes: fts.append(x)
-
-            if verbose:
-                print('%g/%g %s -' % (i, len(self.module_list), mtype), list(x.shape), str)
-                str = ''
+        yolo_out, fts = run_plan(self, x, fts_indexes)
 
         if self.training: # train
             if len(fts_indexes): return yolo_out, fts
@@ -396,6 +499,20 @@ def create_grids(self, img_size=416, ng=(13, 13), device='cpu', type=torch.float
     self.ny = ny
 
 
+def load_grids(self, key, img_size):
+    # Restores the grids of key from the layer LRU cache, building them with create_grids() if not cached
+    if key in self.grids:
+        self.grids.move_to_end(key)
+        self.img_size, self.stride, self.grid_xy, self.anchor_vec, self.anchor_wh, self.ng = self.grids[key]
+        self.nx, self.ny = key[:2]
+    else:
+        create_grids(self, img_size, key[:2], key[3], key[4])
+        self.grids[key] = self.img_size, self.stride, self.grid_xy, self.anchor_vec, self.anchor_wh, self.ng
+        if len(self.grids) > MAX_GRIDS:
+            self.grids.popitem(last=False)  # evict least recently used shape
+    self.grid_key = key
+
+
 def load_darknet_weights(self, weights, cutoff=-1):
     # Parses and loads the weights stored in 'weights'
 
@@ -561,6 +678,7 @@ class SparseYOLO(nn.Module):
 
         self.module_defs = pruned_yolo.module_defs
         self.create_module_list(pruned_yolo)
+        self.plan = create_plan(self.module_defs)  # SparseConv replaces any SoftMaskedConv2d
         self.yolo_layers = pruned_yolo.yolo_layers
 
         # Darknet Header https://github.com/AlexeyAB/darknet/issues/2914#issuecomment-496675346
@@ -601,51 +719,7 @@ class SparseYOLO(nn.Module):
         self.routs = pruned_yolo.routs
     
     def forward(self, x, fts_indexes=[], verbose=False):
-        img_size = x.shape[-2:]
-        yolo_out, out, fts = [], [], []
-        verbose = False
-        if verbose:
-            str = ''
-            print('0', x.shape)
-
-        for i, (mdef, module) in enumerate(zip(self.module_defs, self.module_list)):
-            mtype = mdef['type']
-            if mtype in [
-                    'convolutional', 'multibias', 'multiconv_multibias', 
-                    'halfconv', 'softconv', 'inception', 'upsample', 'maxpool',
-                    'PEP', 'EP', 'FCA', 'mobile'
-                ]:
-                x = module(x)
-            elif mtype == 'shortcut':  # sum
-                if verbose:
-                    l = [i - 1] + module.layers  # layers
-                    s = [list(x.shape)] + [list(out[i].shape) for i in module.layers]  # shapes
-                    str = ' >> ' + ' + '.join(['layer %g %s' % x for x in zip(l, s)])
-                x = module(x, out)  # weightedFeatureFusion()
-            elif mtype == 'route': # concat
-                layers = mdef['layers']
-                if verbose:
-                    l = [i - 1] + layers  # layers
-                    s = [list(x.shape)] + [list(out[i].shape) for i in layers]  # shapes
-                    str = ' >> ' + ' + '.join(['layer %g %s' % x for x in zip(l, s)])
-                if len(layers) == 1:
-                    x = out[layers[0]]
-                else:
-                    try:
-                        x = torch.cat([out[i] for i in layers], 1)
-                    except:  # apply stride 2 for darknet reorg layer
-                        out[layers[1]] = F.interpolate(out[layers[1]], scale_factor=[0.5, 0.5])
-                        x = torch.cat([out[i] for i in layers], 1)
-                    # print(''), [print(out[i].shape) for i in layers], print(x.shape)
-            elif mtype == 'yolo':
-                yolo_out.append(module(x, img_size))
-            out.append(x if i in self.routs else [])
-
-            if i in fts_indexes: fts.append(x)
-
-            if verbose:
-                print('%g/%g %s -' % (i, len(self.module_list), mtype), list(x.shape), str)
-                str = ''
+        yolo_out, fts = run_plan(self, x, fts_indexes)
 
         if self.training: # train
             if len(fts_indexes): return yolo_out, fts
@@ -692,6 +766,7 @@ class SoftDarknet(MaskedNet):
 
         self.module_defs = parse_model_cfg(cfg)
         self.module_list, self.routs = create_modules(self.module_defs, img_size, arc)
+        self.plan = create_plan(self.module_defs, soft=True)
         self.yolo_layers = get_yolo_layers(self)
 
         # Darknet Header https://github.com/AlexeyAB/darknet/issues/2914#issuecomment-496675346
@@ -702,47 +777,7 @@ class SoftDarknet(MaskedNet):
         self.temp = 1
 
     def forward(self, x, verbose=False):
-        img_size = x.shape[-2:]
-        yolo_out, out = [], []
-        verbose = False
-        if verbose:
-            str = ''
-            print('0', x.shape)
-
-        for i, (mdef, module) in enumerate(zip(self.module_defs, self.module_list)):
-            mtype = mdef['type']
-            if mtype in ['convolutional', 'softconv', 'upsample', 'maxpool']:
-                if mtype == 'softconv': 
-                    x1 = module[0](x, self.temp, self.ticket)
-                    x = module[1:](x1)
-                else: x = module(x)
-            elif mtype == 'shortcut':  # sum
-                if verbose:
-                    l = [i - 1] + module.layers  # layers
-                    s = [list(x.shape)] + [list(out[i].shape) for i in module.layers]  # shapes
-                    str = ' >> ' + ' + '.join(['layer %g %s' % x for x in zip(l, s)])
-                x = module(x, out)  # weightedFeatureFusion()
-            elif mtype == 'route': # concat
-                layers = mdef['layers']
-                if verbose:
-                    l = [i - 1] + layers  # layers
-                    s = [list(x.shape)] + [list(out[i].shape) for i in layers]  # shapes
-                    str = ' >> ' + ' + '.join(['layer %g %s' % x for x in zip(l, s)])
-                if len(layers) == 1:
-                    x = out[layers[0]]
-                else:
-                    try:
-                        x = torch.cat([out[i] for i in layers], 1)
-                    except:  # apply stride 2 for darknet reorg layer
-                        out[layers[1]] = F.interpolate(out[layers[1]], scale_factor=[0.5, 0.5])
-                        x = torch.cat([out[i] for i in layers], 1)
-                    # print(''), [print(out[i].shape) for i in layers], print(x.shape)
-            elif mtype == 'yolo':
-                yolo_out.append(module(x, img_size))
-            out.append(x if i in self.routs else [])
-            if verbose:
-                print('%g/%g %s -' % (i, len(self.module_list), mtype), list(x.shape), str)
-                str = ''
+        yolo_out, _ = run_plan(self, x)
 
         if self.training: # train
             return yolo_out
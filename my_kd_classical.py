@@ -156,7 +156,7 @@ def train():
         if trainloader.dataset.image_weights:
             w = student.class_weights.cpu().numpy() * (1 - maps) ** 2  # class weights
             image_weights = labels_to_image_weights(trainloader.dataset.labels, nc=nc, class_weights=w)
-            trainloader.dataset.indices = random.choices(range(trainloader.dataset.n), weights=image_weights, k=trainloader.dataset.n)  # rand weighted idx
+            trainloader.sampler.set_epoch(epoch, image_weights)  # seeded weighted draw of the epoch
 
         mloss = torch.zeros(5).to(device)  # mean losses
         print(('\n' + '%10s' * 9) % ('Epoch', 'gpu_mem', 'GIoU', 'obj', 'cls', 'hint', 'total', 'targets', 'img_size'))
@@ -166,8 +166,11 @@ def train():
         ####################
         for i, (imgs, targets, paths, _) in pbar: 
             ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
-            targets = targets.to(device)
+            imgs, targets = imgs.to(device), targets.to(device)
+            if trainloader.dataset.batch_augment:  # flips and hsv of the whole batch, on device
+                imgs, targets = trainloader.dataset.batch_augment(imgs, targets)
+            else:
+                imgs = imgs.float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
 
             # Plot images with bounding boxes
             if ni < 1:
@@ -308,6 +311,7 @@ def train():
                     'epoch': epoch,
                     'best_fitness': best_fitness,
                     'training_results': f.read(),
+                    'sampler': trainloader.sampler.state_dict() if trainloader.dataset.image_weights else None,
                     'model': student.module.state_dict() if type(student) is nn.parallel.DistributedDataParallel 
                         else student.state_dict(),
                     'hint': None if hint_models is None
@@ -8,7 +8,7 @@ from models import *
 from utils.datasets import *
 from utils.utils import *
 from utils.my_utils import create_prune_argparser, create_config, create_scheduler, create_optimizer, initialize_model, create_dataloaders, load_checkpoints_mask, guarantee_test
-from utils.pruning import sum_of_the_weights, create_backup, rewind_weights, create_mask_LTH, apply_mask_LTH, IMP_LOCAL, IMP_GLOBAL
+from utils.pruning import sum_of_the_weights, WeightSnapshot, rewind_weights, create_mask_LTH, apply_mask_LTH, IMP_LOCAL, IMP_GLOBAL, mask_gradients_LTH, assert_sparsity_LTH
 
 
 
@@ -84,6 +84,8 @@ def train():
         config['last'] = config['sub_working_dir'] + 'last_it_{}.pt'.format(it)
         config['best'] = config['sub_working_dir'] + 'best_it_{}.pt'.format(it)
         max_wo_best = 0
+        if config['mask_grads']:  # Pruned weights zeroed once and kept at zero by masking their gradients
+            mask_gradients_LTH(model, mask, optimizer)
         ###############
         # Start epoch #
         ###############
@@ -109,7 +111,7 @@ def train():
             if trainloader.dataset.image_weights:
                 w = model.class_weights.cpu().numpy() * (1 - maps) ** 2  # class weights
                 image_weights = labels_to_image_weights(trainloader.dataset.labels, nc=nc, class_weights=w)
-                trainloader.dataset.indices = random.choices(range(trainloader.dataset.n), weights=image_weights, k=trainloader.dataset.n)  # rand weighted idx
+                trainloader.sampler.set_epoch(epoch, image_weights)  # seeded weighted draw of the epoch
 
             mloss = torch.zeros(4).to(device)  # mean losses
             print(('\n' + '%10s' * 9) % ('Iter', 'Epoch', 'gpu_mem', 'GIoU', 'obj', 'cls', 'total', 'targets', 'img_size'))
@@ -117,11 +119,7 @@ def train():
 
             # Backup for late reseting
             if epoch == config['reseting']-1:
-                mask = mask.to('cpu')
-                backup = create_backup(model)
-                torch.save(backup.state_dict(), config['sub_working_dir'] + 'bckp_it-{}_epoch-{}.pt'.format(it+1, epoch+1))
-                backup = backup.to('cpu')
-                mask = mask.to(device)
+                backup = WeightSnapshot(config['sub_working_dir'] + 'bckp_it-{}_epoch-{}'.format(it+1, epoch+1), model)
 
             ####################
             # Start mini-batch #
@@ -132,10 +130,14 @@ def train():
                 ##############
                 # Apply mask #
                 ##############
-                apply_mask_LTH(model, mask)
+                if not config['mask_grads']:
+                    apply_mask_LTH(model, mask)
 
-                imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
-                targets = targets.to(device)
+                imgs, targets = imgs.to(device), targets.to(device)
+                if trainloader.dataset.batch_augment:  # flips and hsv of the whole batch, on device
+                    imgs, targets = trainloader.dataset.batch_augment(imgs, targets)
+                else:
+                    imgs = imgs.float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
 
                 # Plot images with bounding boxes
                 if ni < 1:
@@ -184,6 +186,9 @@ def train():
             # End mini-batch #
             ##################
 
+            if config['mask_grads']:  # Hooks kept every pruned weight at zero
+                assert_sparsity_LTH(model, mask)
+
             # Update scheduler
             scheduler.step()
             
@@ -229,6 +234,7 @@ def train():
                             'epoch': epoch,
                             'best_fitness': best_fitness,
                             'training_results': f.read(),
+                            'sampler': trainloader.sampler.state_dict() if trainloader.dataset.image_weights else None,
                             'model': model.module.state_dict() if type(
                                 model) is nn.parallel.DistributedDataParallel else model.state_dict(),
                             'mask' : mask.state_dict(),
@@ -266,12 +272,8 @@ def train():
                 print(f"Applying IMP Global with {config['pruning_rate'] * 100}%.")
                 IMP_GLOBAL(model, mask, config['pruning_rate'])
                 
-            mask = mask.to('cpu')
             print('Rewind weights.')
-            backup = backup.to(device)
-            rewind_weights(model, backup)
-            backup = backup.to('cpu')
-            mask = mask.to(device)
+            rewind_weights(model, backup)  # straight from the memory-mapped snapshot
             config['pruning_time'] += 1
 
         optimizer = create_optimizer(model, config)
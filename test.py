@@ -1,4 +1,6 @@
 import json
+import queue
+import threading
 
 from torch.utils.data import DataLoader
 
@@ -12,6 +14,73 @@ def compute_removed_weights(masks):
     return sum(float((m == 0).sum()) for m in masks)
 
 
+def run_pipeline(source, stages, threads=True, maxsize=2):
+    # Passes each item of source through stages. With threads, every stage runs in its own thread and consecutive
+    # stages are joined by queues of maxsize items. Returns the busy and stall seconds (waiting on an empty input or
+    # a full output queue) of the source and of each stage
+    busy, stall = [0.] * (len(stages) + 1), [0.] * (len(stages) + 1)
+    source = iter(source)
+    if not threads:
+        while True:
+            t = torch_utils.time_synchronized()
+            x = next(source, None)
+            busy[0] += torch_utils.time_synchronized() - t
+            if x is None:
+                return busy, stall
+            for k, fn in enumerate(stages):
+                t = torch_utils.time_synchronized()
+                x = fn(x)
+                busy[k + 1] += torch_utils.time_synchronized() - t
+
+    queues = [queue.Queue(maxsize) for _ in stages] + [None]
+    errors, done = [], object()
+
+    def put(k, q, x):
+        t = time.time()
+        q.put(x)
+        stall[k] += time.time() - t
+
+    def worker(k, fn, q_in, q_out):
+        while True:
+            t = time.time()
+            x = q_in.get()
+            stall[k] += time.time() - t
+            if x is done:
+                break
+            if not errors:  # after an error only drain the input
+                try:
+                    t = torch_utils.time_synchronized()
+                    x = fn(x)
+                    busy[k] += torch_utils.time_synchronized() - t
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if q_out is not None:
+                    put(k, q_out, x)
+        if q_out is not None:
+            q_out.put(done)
+
+    workers = [threading.Thread(target=worker, args=(k + 1, fn, queues[k], queues[k + 1]), daemon=True)
+               for k, fn in enumerate(stages)]
+    for w in workers:
+        w.start()
+    try:
+        while not errors:
+            t = torch_utils.time_synchronized()
+            x = next(source, done)
+            busy[0] += torch_utils.time_synchronized() - t
+            if x is done:
+                break
+            put(0, queues[0], x)
+    finally:
+        queues[0].put(done)
+        for w in workers:
+            w.join()
+    if errors:
+        raise errors[0]
+    return busy, stall
+
+
 def test(cfg,
          data,
          weights=None,
@@ -26,7 +95,11 @@ def test(cfg,
          folder='',
          mask=None,
          mask_weight=None,
-         architecture='default'):
+         architecture='default',
+         topk_per_image=None,
+         topk_per_class=None,
+         max_det=None,
+         pipeline=False):
     # Initialize/load model and set device
     if model is None:
         device = torch_utils.select_device(args['device'], batch_size=batch_size)
@@ -103,36 +176,48 @@ def test(cfg,
     s = ('%20s' + '%10s' * 6) % ('Class', 'Images', 'Targets', 'P', 'R', 'mAP@0.5', 'F1')
     p, r, f1, mp, mr, map, mf1, t0, t1 = 0., 0., 0., 0., 0., 0., 0., 0., 0.
     loss = torch.zeros(3, device=device)
-    jdict, stats, ap, ap_class = [], [], [], []
-    for batch_i, (imgs, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
-        imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
-        targets = targets.to(device)
-        _, _, height, width = imgs.shape  # batch size, channels, height, width
+    jdict, ap, ap_class = [], [], []
+    metrics = APAccumulator(nc, niou)  # streaming (correct, conf, pcls, tcls) statistics
+
+    def batches():  # inference stage, yields (inf_out, targets, paths, shapes, (height, width)) per batch
+        nonlocal t0, loss
+        for batch_i, (imgs, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
+            imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
+            targets = targets.to(device)
+
+            # Plot images with bounding boxes
+            f = folder + 'test_batch%g.png' % batch_i  # filename
+            if batch_i < 1 and not os.path.exists(f):
+                plot_images(imgs=imgs, targets=targets, paths=paths, fname=f)
+
+            # Disable gradients
+            with torch.no_grad():
+                # Run model
+                t = torch_utils.time_synchronized()
+                if hasattr(model, 'hyp') or not hasattr(model, 'plan'):  # loss needed or multi-gpu wrapper
+                    inf_out, train_out = model(imgs)  # inference and training outputs
+                else:
+                    inf_out = inference(model, imgs, conf_thres)  # per image outputs above conf_thres
+                t0 += torch_utils.time_synchronized() - t
+
+                # Compute loss
+                if hasattr(model, 'hyp'):  # if model has loss hyperparameters
+                    loss += compute_loss(train_out, targets, model)[1][:3]  # GIoU, obj, cls
+
+            yield inf_out, targets, paths, shapes, imgs.shape[2:]
+
+    @torch.no_grad()
+    def nms(batch):  # NMS stage
+        inf_out, *batch = batch
+        output = non_max_suppression(inf_out, conf_thres=conf_thres, iou_thres=iou_thres, topk_per_image=topk_per_image,
+                                     topk_per_class=topk_per_class, max_det=max_det)
+        return (output, *batch)
+
+    @torch.no_grad()
+    def statistics(batch):  # statistics stage, per image
+        nonlocal seen
+        output, targets, paths, shapes, (height, width) = batch
         whwh = torch.Tensor([width, height, width, height]).to(device)
-
-        # Plot images with bounding boxes
-        f = folder + 'test_batch%g.png' % batch_i  # filename
-        if batch_i < 1 and not os.path.exists(f):
-            plot_images(imgs=imgs, targets=targets, paths=paths, fname=f)
-
-
-        # Disable gradients
-        with torch.no_grad():
-            # Run model
-            t = torch_utils.time_synchronized()
-            inf_out, train_out = model(imgs)  # inference and training outputs
-            t0 += torch_utils.time_synchronized() - t
-
-            # Compute loss
-            if hasattr(model, 'hyp'):  # if model has loss hyperparameters
-                loss += compute_loss(train_out, targets, model)[1][:3]  # GIoU, obj, cls
-
-            # Run NMS
-            t = torch_utils.time_synchronized()
-            output = non_max_suppression(inf_out, conf_thres=conf_thres, iou_thres=iou_thres)
-            t1 += torch_utils.time_synchronized() - t
-
-        # Statistics per image
         for si, pred in enumerate(output):
             labels = targets[targets[:, 0] == si, 1:]
             nl = len(labels)
@@ -141,7 +226,7 @@ def test(cfg,
 
             if pred is None:
                 if nl:
-                    stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
+                    metrics.update(np.zeros((0, niou), dtype=bool), [], [], tcls)
                 continue
 
             # Append to text file
@@ -156,7 +241,7 @@ def test(cfg,
                 # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
                 image_id = int(Path(paths[si]).stem.split('_')[-1])
                 box = pred[:, :4].clone()  # xyxy
-                scale_coords(imgs[si].shape[1:], box, shapes[si][0], shapes[si][1])  # to original shape
+                scale_coords((height, width), box, shapes[si][0], shapes[si][1])  # to original shape
                 box = xyxy2xywh(box)  # xywh
                 box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
                 for di, d in enumerate(pred):
@@ -168,42 +253,34 @@ def test(cfg,
             # Assign all predictions as incorrect
             correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
             if nl:
-                detected = []  # target indices
-                tcls_tensor = labels[:, 0]
-
                 # target boxes
                 tbox = xywh2xyxy(labels[:, 1:5]) * whwh
 
-                # Per target class
-                for cls in torch.unique(tcls_tensor):
-                    ti = (cls == tcls_tensor).nonzero().view(-1)  # prediction indices
-                    pi = (cls == pred[:, 5]).nonzero().view(-1)  # target indices
-
-                    # Search for detections
-                    if pi.shape[0]:
-                        # Prediction to target ious
-                        ious, i = box_iou(pred[pi, :4], tbox[ti]).max(1)  # best ious, indices
-
-                        # Append detections
-                        for j in (ious > iouv[0]).nonzero():
-                            d = ti[i[j]]  # detected target
-                            if d not in detected:
-                                detected.append(d)
-                                correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                if len(detected) == nl:  # all targets already located in image
-                                    break
+                # Best same class target of each prediction, in nms (descending conf) order
+                iou = box_iou(pred[:, :4], tbox)
+                iou[pred[:, 5:6] != labels[:, 0]] = -1  # other classes
+                ious, i = iou.max(1)  # best ious, target indices
+
+                # Each target is detected by its first prediction with iou > iouv[0]
+                j = (ious > iouv[0]).nonzero().view(-1)  # prediction indices
+                first = torch.full((nl,), len(pred), device=device).scatter_reduce_(0, i[j], j, 'amin')
+                j = first[first < len(pred)]  # detecting prediction of each detected target
+                correct[j] = ious[j, None] > iouv  # iou_thres is 1xn
 
             # Append statistics (correct, conf, pcls, tcls)
-            stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
+            metrics.update(correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls)
+
+    # Run inference -> NMS -> statistics, overlapped in threads joined by bounded queues if pipeline
+    busy, stall = run_pipeline(batches(), [nms, statistics], threads=pipeline)
+    t1 = busy[1]
 
     # Compute statistics
-    stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
-    if len(stats):
-        p, r, ap, f1, ap_class = ap_per_class(*stats)
+    if metrics.seen:
+        p, r, ap, f1, ap_class = metrics.compute()
         if niou > 1:
             p, r, ap, f1 = p[:, 0], r[:, 0], ap.mean(1), ap[:, 0]  # [P, R, AP@0.5:0.95, AP@0.5]
         mp, mr, map, mf1 = p.mean(), r.mean(), ap.mean(), f1.mean()
-        nt = np.bincount(stats[3].astype(np.int64), minlength=nc)  # number of targets per class
+        nt = metrics.n_gt  # number of targets per class
     else:
         nt = torch.zeros(1)
 
@@ -221,7 +298,7 @@ def test(cfg,
     class_results.close()
 
     # Print results per class
-    if verbose and nc > 1 and len(stats):
+    if verbose and nc > 1 and metrics.seen:
         for i, c in enumerate(ap_class):
             print(pf % (names[c], seen, nt[c], p[i], r[i], ap[i], f1[i]))
 
@@ -253,6 +330,8 @@ def test(cfg,
     if verbose:
         t = tuple(x / seen * 1E3 for x in (t0, t1, t0 + t1)) + (img_size, img_size, batch_size)  # tuple
         print('Speed: %.1f/%.1f/%.1f ms inference/NMS/total per %gx%g image at batch-size %g' % t)
+        for name, b, w in zip(('load+inference', 'NMS', 'statistics'), busy, stall):
+            print('%20s: %8.1f img/s busy, %6.1fs busy, %6.1fs stalled on queues' % (name, seen / (b + 1E-9), b, w))
 
     # Return results
     maps = np.zeros(nc) + map
@@ -265,13 +344,15 @@ if __name__ == '__main__':
     args = create_test_argparser()
     args['save_json'] = args['save_json'] or any([x in args['data'] for x in ['coco.data', 'coco2014.data', 'coco2017.data']])
     print(args)
+    caps = {k: args[k] for k in ['topk_per_image', 'topk_per_class', 'max_det']}  # nms candidate caps
 
     if args['task'] == 'test':  # test normally
         test(
                 cfg = args['cfg'], data = args['data'], weights = args['weights'],
                 batch_size = args['batch_size'], img_size = args['img_size'], conf_thres = args['conf_thres'],
                 iou_thres = args['iou_thres'], save_json = args['save_json'], folder = args['working_dir'],
-                mask = args['mask'], mask_weight = args['mask_weight'], architecture = args['architecture']
+                mask = args['mask'], mask_weight = args['mask_weight'], architecture = args['architecture'],
+                pipeline = args['pipeline'], **caps
             )
 
     elif args['task'] == 'benchmark': # mAPs at 320-608 at conf 0.5 and 0.7
@@ -283,9 +364,22 @@ if __name__ == '__main__':
                         cfg = args['cfg'], data = args['data'], weights = args['weights'], 
                         batch_size = args['batch_size'], img_size = i, conf_thres = args['conf_thres'], 
                         iou_thres = j, save_json = args['save_json'], folder = args['working_dir'],
-                        mask = args['mask'], mask_weight = args['mask_weight'], architecture = args['architecture']
+                        mask = args['mask'], mask_weight = args['mask_weight'], architecture = args['architecture'],
+                        pipeline = args['pipeline'], **caps
                     )[0]
                 y.append(r + (time.time() - t,))
+                if any(caps.values()):  # mAP impact of the nms caps, appends uncapped mAP and time
+                    t = time.time()
+                    r0 = test(
+                            cfg = args['cfg'], data = args['data'], weights = args['weights'],
+                            batch_size = args['batch_size'], img_size = i, conf_thres = args['conf_thres'],
+                            iou_thres = j, save_json = args['save_json'], folder = args['working_dir'],
+                            mask = args['mask'], mask_weight = args['mask_weight'], architecture = args['architecture'],
+                            pipeline = args['pipeline']
+                        )[0]
+                    y[-1] += (r0[2], time.time() - t)
+                    print('%g img-size, %g iou-thres: mAP@0.5 %.4g with nms caps, %.4g without (%+.4g)' %
+                          (i, j, r[2], r0[2], r[2] - r0[2]))
         np.savetxt(args['working_dir'] + 'benchmark.txt', y, fmt='%10.4g')  # y = np.loadtxt('study.txt')
 
     elif args['task'] == 'study': # Parameter study
@@ -297,7 +391,8 @@ if __name__ == '__main__':
                 cfg = args['cfg'], data = args['data'], weights = args['weights'], 
                 batch_size = args['batch_size'], img_size = args['img_size'], conf_thres = args['conf_thres'], 
                 iou_thres = i, save_json = args['save_json'], folder = args['working_dir'],
-                mask = args['mask'], mask_weight = args['mask_weight'], architecture = args['architecture']
+                mask = args['mask'], mask_weight = args['mask_weight'], architecture = args['architecture'],
+                pipeline = args['pipeline'], **caps
             )[0]
             y.append(r + (time.time() - t,))
         np.savetxt(args['working_dir'] + 'study.txt', y, fmt='%10.4g')  # y = np.loadtxt('study.txt')
@@ -1,17 +1,25 @@
+import copy
 import glob
+import hashlib
+import json
 import math
 import os
+import queue
 import random
 import shutil
+import tarfile
 import time
+import weakref
+from collections import deque
 from pathlib import Path
-from threading import Thread
+from multiprocessing.pool import Pool, ThreadPool
+from threading import Event, Lock, Thread
 
 import cv2
 import numpy as np
 import torch
 from PIL import Image, ExifTags
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler
 from tqdm import tqdm
 
 from utils.utils import xyxy2xywh, xywh2xyxy
@@ -41,8 +49,40 @@ def exif_size(img):
     return s
 
 
+def load_shapes(files, cache):
+    # Returns the exif-corrected (width, height) of files from a binary shape index keyed by path, mtime and size.
+    # Only new or changed files are read, with a pool of workers, and the index is then rewritten
+    st = [os.stat(f) for f in files]
+    st = np.array([[x.st_mtime_ns, x.st_size] for x in st], dtype=np.int64).reshape(-1, 2)
+    try:
+        c = np.load(cache)
+        index = {f: i for i, f in enumerate(c['files'].tobytes().decode().split('\n'))}
+        j = np.array([index.get(f, -1) for f in files])
+        wh = np.where((j >= 0)[:, None], c['wh'][j], 0)
+        new = ~((j >= 0) & (c['stat'][j] == st).all(1))  # new or changed files
+    except:
+        wh, new = np.zeros((len(files), 2), dtype=np.int64), np.ones(len(files), dtype=np.bool_)
+
+    if new.any():
+        def size(f):
+            with Image.open(f) as img:
+                return exif_size(img)
+
+        i = np.nonzero(new)[0]
+        with ThreadPool(min(os.cpu_count(), 16)) as pool:
+            wh[i] = list(tqdm(pool.imap(size, [files[k] for k in i]), total=len(i), desc='Reading image shapes'))
+        try:
+            f = cache + '.%g.tmp' % os.getpid()
+            with open(f, 'wb') as fp:
+                np.savez(fp, files=np.frombuffer('\n'.join(files).encode(), dtype=np.uint8), stat=st, wh=wh)
+            os.replace(f, cache)
+        except OSError:
+            print('WARNING: can not write shape index %s' % cache)
+    return wh
+
+
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=416):
+    def __init__(self, path, img_size=416, prefetch=0, batch=1):
         path = str(Path(path))  # os-agnostic
         files = []
         if os.path.isdir(path):
@@ -59,6 +99,10 @@ class LoadImages:  # for inference
         self.nF = nI + nV  # number of files
         self.video_flag = [False] * nI + [True] * nV
         self.mode = 'images'
+        self.prefetch = prefetch  # batches decoded ahead by a background thread (0 to decode in __next__)
+        self.batch = batch  # consecutive video frames per batch, returned as lists and a 4D img if > 1
+        self.caps = deque()  # opened video captures, released once __next__ moves past them
+        self.thread, self.stop = None, Event()
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -67,36 +111,102 @@ class LoadImages:  # for inference
 
     def __iter__(self):
         self.count = 0
+        if self.prefetch:
+            self.queue = queue.Queue(maxsize=self.prefetch)  # bounded, decoding stays at most prefetch batches ahead
+            self.stop.clear()
+            self.thread = Thread(target=self.produce, daemon=True)
+            self.thread.start()
         return self
 
     def __next__(self):
-        if self.count == self.nF:
+        try:
+            x = self.queue.get() if self.prefetch else self.read()
+        except Exception:
+            self.close()
+            raise
+        if isinstance(x, Exception):  # raised by the decode thread
+            self.close()
+            raise x
+        if x is None:
+            self.close()
             raise StopIteration
+        path, img, img0, cap, self.mode, s = x
+        while self.caps and self.caps[0] is not cap:  # videos before this one are done
+            self.caps.popleft().release()
+        print(s, end='')
+        return path, img, img0, cap
+
+    def produce(self):
+        # Decode thread: read() into the queue until the last file or close(), passing on any error
+        try:
+            x = self.read()
+            while x is not None and not self.stop.is_set():
+                self.queue.put(x)
+                x = self.read()
+        except Exception as e:
+            x = e
+        self.queue.put(x)
+
+    def close(self):
+        # Stops the decode thread and releases all video captures, also when the iteration is abandoned early
+        if self.thread is not None:
+            self.stop.set()
+            while self.thread.is_alive():  # unblock its put()
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.thread.join()
+            self.thread = None
+        while self.caps:
+            self.caps.popleft().release()
+
+    def __del__(self):
+        self.close()
+
+    def read(self):
+        # Returns the next (path, img, img0, cap, mode, print string) or None after the last file
+        if self.count == self.nF:
+            return None
         path = self.files[self.count]
 
         if self.video_flag[self.count]:
             # Read video
-            self.mode = 'video'
+            mode = 'video'
             ret_val, img0 = self.cap.read()
             if not ret_val:
                 self.count += 1
-                self.cap.release()
                 if self.count == self.nF:  # last video
-                    raise StopIteration
+                    return None
                 else:
                     path = self.files[self.count]
-                    self.new_video(path)
+                    self.new_video(path)  # previous capture released by __next__ once it moves past it
                     ret_val, img0 = self.cap.read()
 
+            if self.batch > 1:  # consecutive frames of this video
+                img0 = [img0]
+                while len(img0) < self.batch:
+                    ret_val, x = self.cap.read()
+                    if not ret_val:
+                        break
+                    img0.append(x)
+                self.frame += len(img0) - 1
+
             self.frame += 1
-            print('video %g/%g (%g/%g) %s: ' % (self.count + 1, self.nF, self.frame, self.nframes, path), end='')
+            s = 'video %g/%g (%g/%g) %s: ' % (self.count + 1, self.nF, self.frame, self.nframes, path)
 
         else:
             # Read image
+            mode = 'images'
             self.count += 1
             img0 = cv2.imread(path)  # BGR
             assert img0 is not None, 'Image Not Found ' + path
-            print('image %g/%g %s: ' % (self.count, self.nF, path), end='')
+            s = 'image %g/%g %s: ' % (self.count, self.nF, path)
+
+        if isinstance(img0, list):
+            # Padded resize and convert, BGR to RGB, to nx3x416x416
+            img = np.stack([letterbox(x, new_shape=self.img_size)[0] for x in img0], 0)[..., ::-1].transpose(0, 3, 1, 2)
+            return [path] * len(img0), np.ascontiguousarray(img), img0, self.cap, mode, s
 
         # Padded resize
         img = letterbox(img0, new_shape=self.img_size)[0]
@@ -106,11 +216,12 @@ class LoadImages:  # for inference
         img = np.ascontiguousarray(img)
 
         # cv2.imwrite(path + '.letterbox.jpg', 255 * img.transpose((1, 2, 0))[:, :, ::-1])  # save letterbox image
-        return path, img, img0, self.cap
+        return path, img, img0, self.cap, mode, s
 
     def new_video(self, path):
         self.frame = 0
         self.cap = cv2.VideoCapture(path)
+        self.caps.append(self.cap)
         self.nframes = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
     def __len__(self):
@@ -183,9 +294,15 @@ class LoadWebcam:  # for inference
 
 
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=416):
+    # One reader thread per stream, reading at the stream rate. drop='latest' hands off only the newest frame of each
+    # stream, 'nth' decodes every nth frame (the others are grabbed and dropped) and hands it off, 'queue' keeps every
+    # frame in a bounded queue that blocks the reader when full. Each batch has one new frame of every stream and
+    # self.timestamps holds their capture times
+    def __init__(self, sources='streams.txt', img_size=416, drop='latest', nth=4, maxsize=8):
+        assert drop in ('latest', 'nth', 'queue'), 'Unknown drop policy %s' % drop
         self.mode = 'images'
         self.img_size = img_size
+        self.drop, self.nth = drop, nth
 
         if os.path.isfile(sources):
             with open(sources, 'r') as f:
@@ -195,6 +312,12 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
         n = len(sources)
         self.imgs = [None] * n
+        self.timestamps = [0.] * n  # capture times of the last batch
+        self.frames = [None] * n  # (timestamp, frame) handed off by each reader, taken by __next__
+        self.locks = [Lock() for _ in range(n)]  # guard each take and hand off of self.frames
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(n)] if drop == 'queue' else None
+        self.events = [Event() for _ in range(n)]  # new frame or end of stream
+        self.done = [False] * n
         self.sources = sources
         for i, s in enumerate(sources):
             # Start the thread to read frames from the video stream
@@ -205,6 +328,7 @@ class LoadStreams:  # multiple IP or RTSP cameras
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             fps = cap.get(cv2.CAP_PROP_FPS) % 100
             _, self.imgs[i] = cap.read()  # guarantee first frame
+            self.hand_off(i, time.time(), self.imgs[i])
             thread = Thread(target=self.update, args=([i, cap]), daemon=True)
             print(' success (%gx%g at %.2f FPS).' % (w, h, fps))
             thread.start()
@@ -216,17 +340,31 @@ class LoadStreams:  # multiple IP or RTSP cameras
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
+    def hand_off(self, index, t, img):
+        if self.queues:
+            self.queues[index].put((t, img))  # blocks the reader while the queue is full
+        else:
+            with self.locks[index]:
+                self.frames[index] = t, img  # replaces any frame not taken yet
+        self.events[index].set()
+
     def update(self, index, cap):
         # Read next stream frame in a daemon thread
         n = 0
         while cap.isOpened():
             n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
-                _, self.imgs[index] = cap.retrieve()
-                n = 0
-            time.sleep(0.01)  # wait time
+            if self.drop == 'nth' and n % self.nth:
+                if not cap.grab():  # dropped without decoding
+                    break
+                continue
+            ret_val, img = cap.read()
+            if not ret_val:
+                break
+            self.hand_off(index, time.time(), img)
+        self.done[index] = True  # end of stream
+        if self.queues:
+            self.queues[index].put(None)
+        self.events[index].set()
 
     def __iter__(self):
         self.count = -1
@@ -234,16 +372,29 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
         if cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
 
-        # Letterbox
-        img = [letterbox(x, new_shape=self.img_size, auto=self.rect, interp=cv2.INTER_LINEAR)[0] for x in img0]
+        # Next frame of every stream
+        for i, e in enumerate(self.events):
+            if self.queues:
+                x = self.queues[i].get()
+            else:
+                while True:
+                    with self.locks[i]:
+                        x, self.frames[i] = self.frames[i], None  # take the newest frame
+                    if x is not None or self.done[i]:
+                        break
+                    e.wait()
+                    e.clear()
+            if x is None:  # end of stream
+                raise StopIteration
+            self.timestamps[i], self.imgs[i] = x
+        img0 = self.imgs.copy()
 
-        # Stack
-        img = np.stack(img, 0)
+        # Letterbox and stack
+        img = letterbox_batch(img0, new_shape=self.img_size, auto=self.rect, interp=cv2.INTER_LINEAR)
 
         # Convert
         img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to bsx3x416x416
@@ -257,7 +408,7 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=416, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_labels=True, cache_images=False, single_cls=False):
+                 cache_labels=True, cache_images=False, single_cls=False, batch_augment=False):
         path = str(Path(path))  # os-agnostic
         assert os.path.isfile(path), 'File not found %s. See %s' % (path, help_url)
         with open(path, 'r') as f:
@@ -276,6 +427,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
+        self.batch_augment = BatchAugment(hyp) if batch_augment and augment else None  # flips and hsv after collate
 
         # Define labels
         self.label_files = [x.replace('images', 'labels').replace(os.path.splitext(x)[-1], '.txt')
@@ -284,17 +436,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Rectangular Training  https://github.com/ultralytics/yolov3/issues/232
         if self.rect:
             # Read image shapes (wh)
-            sp = path.replace('.txt', '.shapes')  # shapefile path
-            try:
-                with open(sp, 'r') as f:  # read existing shapefile
-                    s = [x.split() for x in f.read().splitlines()]
-                    assert len(s) == n, 'Shapefile out of sync'
-            except:
-                s = [exif_size(Image.open(f)) for f in tqdm(self.img_files, desc='Reading image shapes')]
-                np.savetxt(sp, s, fmt='%g')  # overwrites existing (if any)
+            s = load_shapes(self.img_files, os.path.splitext(path)[0] + '.shapes.npz')
 
             # Sort by aspect ratio
-            s = np.array(s, dtype=np.float64)
+            s = s.astype(np.float64)
             ar = s[:, 1] / s[:, 0]  # aspect ratio
             i = ar.argsort()
             self.img_files = [self.img_files[i] for i in i]
@@ -321,24 +466,19 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             self.labels = [np.zeros((0, 5))] * n
             extract_bounding_boxes = False
             create_datasubset = False
-            pbar = tqdm(self.label_files, desc='Caching labels')
-            nm, nf, ne, ns, nd = 0, 0, 0, 0, 0  # number missing, found, empty, datasubset, duplicate
-            for i, file in enumerate(pbar):
-                try:
-                    with open(file, 'r') as f:
-                        l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
-                except:
+            cache = os.path.splitext(path)[0] + '.labels.npz'  # binary label cache of the image list
+            labels, duplicate = load_labels(self.label_files, cache, os.path.splitext(path)[0] + '.report.json')
+            if single_cls:
+                for l in labels:
+                    if l is not None:
+                        l[:, 0] = 0  # force dataset into single-class mode
+            nm, nf, ne, ns, nd = 0, 0, 0, 0, int(duplicate.sum())  # number missing, found, empty, datasubset, duplicate
+            for i, l in enumerate(labels):
+                if l is None:
                     nm += 1  # print('missing labels for image %s' % self.img_files[i])  # file missing
                     continue
 
                 if l.shape[0]:
-                    assert l.shape[1] == 5, '> 5 label columns: %s' % file
-                    assert (l >= 0).all(), 'negative labels: %s' % file
-                    assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels: %s' % file
-                    if np.unique(l, axis=0).shape[0] < l.shape[0]:  # duplicate rows
-                        nd += 1  # print('WARNING: duplicate rows in %s' % self.label_files[i])  # duplicate rows
-                    if single_cls:
-                        l[:, 0] = 0  # force dataset into single-class mode
                     self.labels[i] = l
                     nf += 1  # file found
 
@@ -376,19 +516,13 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                     ne += 1  # print('empty labels for image %s' % self.img_files[i])  # file empty
                     # os.system("rm '%s' '%s'" % (self.img_files[i], self.label_files[i]))  # remove
 
-                pbar.desc = 'Caching labels (%g found, %g missing, %g empty, %g duplicate, for %g images)' % (
-                    nf, nm, ne, nd, n)
+            print('Caching labels (%g found, %g missing, %g empty, %g duplicate, for %g images)' % (nf, nm, ne, nd, n))
             assert nf > 0, 'No labels found. See %s' % help_url
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        if cache_images:  # if training
-            gb = 0  # Gigabytes of cached images
-            pbar = tqdm(range(len(self.img_files)), desc='Caching images')
-            self.img_hw0, self.img_hw = [None] * n, [None] * n
-            for i in pbar:  # max 10k images
-                self.imgs[i], self.img_hw0[i], self.img_hw[i] = load_image(self, i)  # img, hw_original, hw_resized
-                gb += self.imgs[i].nbytes
-                pbar.desc = 'Caching images (%.1fGB)' % (gb / 1E9)
+        if cache_images:  # if training, images are memory-mapped from disk and shared by all workers
+            cache = os.path.splitext(path)[0] + '.images%g%s' % (img_size, 'a' if augment else '')
+            self.imgs, self.img_hw0, self.img_hw = load_image_cache(self, cache)
 
         # Detect corrupted images https://medium.com/joelthchao/programmatically-detect-corrupted-image-8c1b2006c3d3
         detect_corrupted_images = False
@@ -410,9 +544,6 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
     #     return self
 
     def __getitem__(self, index):
-        if self.image_weights:
-            index = self.indices[index]
-
         img_path = self.img_files[index]
         label_path = self.label_files[index]
 
@@ -434,7 +565,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
             # Load labels
             labels = []
-            if os.path.isfile(label_path):
+            if self.labels[index] is not None or os.path.isfile(label_path):
                 x = self.labels[index]
                 if x is None:  # labels not preloaded
                     with open(label_path, 'r') as f:
@@ -458,7 +589,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                                             shear=hyp['shear'])
 
             # Augment colorspace
-            augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+            if not self.batch_augment:
+                augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
             # Apply cutouts
             # if random.random() < 0.9:
@@ -473,7 +605,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels[:, [2, 4]] /= img.shape[0]  # height
             labels[:, [1, 3]] /= img.shape[1]  # width
 
-        if self.augment:
+        if self.augment and not self.batch_augment:
             # random left-right flip
             lr_flip = True
             if lr_flip and random.random() < 0.5:
@@ -505,13 +637,385 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             l[:, 0] = i  # add target image index for build_targets()
         return torch.stack(img, 0), torch.cat(label, 0), path, shapes
 
+    def collate_ring(self, batch_size, workers=0, prefetch_factor=2):
+        # Returns a collate_fn stacking batches into reusable shared, pinned buffers sized for the largest batch.
+        # prefetch_factor must be the DataLoader one. Takes workers * (prefetch_factor + 2) * largest batch bytes
+        hw = self.batch_shapes.prod(1).max() if self.rect else self.img_size ** 2
+        return CollateRing(batch_size * 3 * int(hw), workers, prefetch_factor)
+
+
+_rings = weakref.WeakValueDictionary()  # CollateRing by key, for ring_view() in the main process
+
+
+def ring_view(key, i, shape):
+    # Unpickles a worker batch as a view of slot i of the main process ring
+    return _rings[key].buf[i, :int(np.prod(shape))].view(shape)
+
+
+class RingSlot:
+    # Images of a worker batch already written into ring slot i, pickled as the slot number only
+    def __init__(self, key, i, shape):
+        self.key, self.i, self.shape = key, i, shape
+
+    def __reduce__(self):
+        return ring_view, (self.key, self.i, self.shape)
+
+
+class CollateRing:
+    # LoadImagesAndLabels.collate_fn() writing images straight into a ring of uint8 batch buffers instead of a fresh
+    # torch.stack() per step. Buffers are in shared memory when workers > 0 (workers return the slot, not the pixels)
+    # and page-locked when CUDA is available, so DataLoader(pin_memory=True) neither copies nor pins them again.
+    # Each worker cycles through prefetch + 2 own slots: the DataLoader keeps at most prefetch batches of a worker in
+    # flight, plus the batch in use by the training loop and the one being copied to the device
+    def __init__(self, numel, workers=0, prefetch=2):
+        self.prefetch = prefetch  # DataLoader prefetch_factor the ring is sized for
+        self.k = prefetch + 2  # slots per worker
+        n = max(workers, 1) * self.k
+        cuda = torch.cuda.is_available()
+        self.pinned = False  # page-locked by cudaHostRegister(), undone in __del__()
+        if workers:
+            self.buf = torch.empty((n, numel), dtype=torch.uint8).share_memory_()
+            if cuda:
+                cudart = torch.cuda.cudart()
+                self.pinned = cudart.cudaHostRegister(self.buf.data_ptr(), self.buf.numel(), 0) == cudart.cudaError.success
+        else:
+            self.buf = torch.empty((n, numel), dtype=torch.uint8, pin_memory=cuda)
+        self.pid = os.getpid()
+        self.key = '%d-%d' % (self.pid, id(self))
+        self.count = 0  # batches collated by this process
+        _rings[self.key] = self
+
+    def __call__(self, batch):
+        img, label, path, shapes = zip(*batch)  # transposed
+        for i, l in enumerate(label):
+            l[:, 0] = i  # add target image index for build_targets()
+        shape = (len(img),) + img[0].shape
+        if np.prod(shape) > self.buf.shape[1]:  # larger than planned, fall back to a fresh batch
+            return torch.stack(img, 0), torch.cat(label, 0), path, shapes
+
+        info = torch.utils.data.get_worker_info()
+        i = (info.id if info else 0) * self.k + self.count % self.k  # ring slot
+        self.count += 1
+        torch.stack(img, 0, out=self.buf[i, :int(np.prod(shape))].view(shape))
+        imgs = RingSlot(self.key, i, shape) if info else ring_view(self.key, i, shape)
+        return imgs, torch.cat(label, 0), path, shapes
+
+    def __del__(self):
+        if self.pinned and os.getpid() == self.pid:  # not in workers
+            torch.cuda.cudart().cudaHostUnregister(self.buf.data_ptr())
+
+
+class ImageWeightSampler(Sampler):
+    # Dataset indices in order, or n draws with replacement by image weight through a cumulative sum and a vectorized
+    # binary search. Draws are seeded by (seed, epoch) and state_dict() keeps the position within the epoch, so a run
+    # resumed from a checkpoint continues the same sequence
+    def __init__(self, n, seed=0):
+        self.n, self.seed = n, seed
+        self.epoch, self.position = 0, 0  # current epoch, indices of it already yielded
+        self.weights = None  # in order
+
+    def set_epoch(self, epoch, weights=None):
+        if epoch == self.epoch and 0 < self.position < self.n:
+            return  # resumed mid-epoch, keep the weights of the interrupted draw
+        self.epoch, self.position = epoch, 0
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+
+    def indices(self):
+        if self.weights is None:
+            return np.arange(self.n)
+        c = np.cumsum(self.weights)
+        r = np.random.default_rng([self.seed, self.epoch]).random(self.n) * c[-1]
+        return np.searchsorted(c, r, side='right').clip(max=self.n - 1)
+
+    def __iter__(self):
+        if self.position >= self.n:  # new pass without set_epoch()
+            self.position = 0
+        for i in self.indices()[self.position:].tolist():
+            self.position += 1
+            yield i
+
+    def __len__(self):
+        return self.n
+
+    def state_dict(self):  # tensors only, loads with torch.load(weights_only=True)
+        weights = None if self.weights is None else torch.from_numpy(self.weights)
+        return {'seed': self.seed, 'epoch': self.epoch, 'position': self.position, 'weights': weights}
+
+    def load_state_dict(self, state):
+        self.seed, self.epoch, self.position = state['seed'], state['epoch'], state['position']
+        self.weights = None if state['weights'] is None else np.asarray(state['weights'], dtype=np.float64)
+
+
+class LoadShards(IterableDataset):  # for training/testing from convert_shards() output
+    def __init__(self, path, img_size=416, batch_size=16, augment=False, hyp=None, buffer=1000, single_cls=False,
+                 batch_augment=False):
+        self.path = str(Path(path))  # shard folder
+        assert os.path.isfile(os.path.join(self.path, 'index.npz')), 'Shard index not found in %s' % self.path
+        x = np.load(os.path.join(self.path, 'index.npz'))
+        self.shards = x['shards'].tolist()
+        self.img_files = x['files'].tolist()  # original image paths
+        self.shapes = x['shapes']  # wh
+        self.labels = np.split(x['labels'], x['offsets'][1:-1])
+        if single_cls:
+            for l in self.labels:
+                l[:, 0] = 0  # force dataset into single-class mode
+        self.label_files = [''] * len(self.labels)  # labels are all in the index
+
+        self.n = len(self.img_files)
+        self.img_size = img_size
+        self.augment = augment
+        self.hyp = hyp
+        self.image_weights = False
+        self.rect = False
+        self.buffer = buffer if augment else 1  # shuffle buffer size, in encoded images
+        self.batch_augment = BatchAugment(hyp) if batch_augment and augment else None  # flips and hsv after collate
+        print('Reading %g images from %g shards in %s' % (self.n, len(self.shards), self.path))
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        shards = list(self.shards)
+        if self.augment:  # new shard order each epoch, the same in every worker
+            random.Random(info.seed - info.id if info else random.random()).shuffle(shards)
+        if info:
+            shards = shards[info.id::info.num_workers]  # shards of this worker
+
+        # Shuffle buffer of encoded images, indexed by LoadImagesAndLabels.__getitem__() (mosaic tiles come from it)
+        w = copy.copy(self)
+        w.imgs, w.labels, w.img_files, w.label_files = [], [], [], []
+        for f in shards:
+            with tarfile.open(os.path.join(self.path, f), 'r|') as tar:  # read sequentially
+                for m in tar:
+                    i = int(os.path.splitext(m.name)[0])  # dataset index
+                    img = np.frombuffer(tar.extractfile(m).read(), dtype=np.uint8)
+                    if len(w.imgs) < self.buffer:
+                        w.imgs.append(img)
+                        w.labels.append(self.labels[i])
+                        w.img_files.append(self.img_files[i])
+                        w.label_files.append('')
+                        continue
+
+                    j = random.randrange(self.buffer)  # emit a random buffered image to make room for this one
+                    yield LoadImagesAndLabels.__getitem__(w, j)
+                    w.imgs[j], w.labels[j], w.img_files[j] = img, self.labels[i], self.img_files[i]
+
+        for j in random.sample(range(len(w.imgs)), len(w.imgs)) if self.augment else range(len(w.imgs)):
+            yield LoadImagesAndLabels.__getitem__(w, j)
+
+    collate_fn = staticmethod(LoadImagesAndLabels.collate_fn)
+    collate_ring = LoadImagesAndLabels.collate_ring
+
+
+class BatchAugment:
+    # Left-right flips and augment_hsv() of a collated uint8 batch at once, on the batch device. Returns 0 - 1 float
+    # images and targets, for datasets built with batch_augment=True. Scale jitter stays per image in random_affine()
+    # (hyp['scale']) and per batch in the training scripts' --multi_scale F.interpolate()
+    def __init__(self, hyp, lr_flip=0.5):
+        self.gains = hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']
+        self.lr_flip = lr_flip  # flip probability
+
+    def __call__(self, imgs, targets):
+        imgs = imgs.float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
+        bs = imgs.shape[0]
+
+        # random left-right flip
+        f = torch.rand(bs, device=imgs.device) < self.lr_flip
+        imgs = torch.where(f.view(-1, 1, 1, 1), imgs.flip(3), imgs)
+        if len(targets):
+            targets = targets.clone()
+            i = f[targets[:, 0].long()]
+            targets[i, 2] = 1 - targets[i, 2]
+
+        # Augment colorspace, random gains per image
+        x = (torch.rand(bs, 3, device=imgs.device) * 2 - 1) * torch.tensor(self.gains, device=imgs.device) + 1
+        h, s, v = rgb_to_hsv(imgs)
+        h = (h * x[:, 0, None, None]).clamp(max=1)  # hue clip
+        s = (s * x[:, 1, None, None]).clamp(max=1)
+        v = (v * x[:, 2, None, None]).clamp(max=1)
+        imgs = hsv_to_rgb(h, s, v)
+        return imgs, targets
+
+
+def rgb_to_hsv(img):
+    # Returns hue, saturation and value (all 0 - 1) of a (..., 3, h, w) RGB tensor in 0 - 1
+    r, g, b = img.unbind(-3)
+    v, _ = img.max(-3)
+    d = v - img.min(-3)[0]  # chroma
+    s = d / v.clamp(min=1e-8)
+    dc = d.clamp(min=1e-8)
+    h = torch.where(v == r, (g - b) / dc, torch.where(v == g, (b - r) / dc + 2, (r - g) / dc + 4))
+    h = torch.where(d > 0, (h / 6) % 1, torch.zeros_like(h))
+    return h, s, v
+
+
+def hsv_to_rgb(h, s, v):
+    # Returns the (..., 3, h, w) RGB tensor of hue, saturation and value (all 0 - 1)
+    h6 = h * 6
+    i = h6.floor()
+    f = h6 - i
+    p, q, t = v * (1 - s), v * (1 - s * f), v * (1 - s * (1 - f))
+    i = (i.long() % 6).unsqueeze(-3)
+    r = torch.stack((v, q, p, p, t, v), -3).gather(-3, i)
+    g = torch.stack((t, v, v, q, p, p), -3).gather(-3, i)
+    b = torch.stack((p, p, t, v, v, q), -3).gather(-3, i)
+    return torch.cat((r, g, b), -3)
+
+
+LABEL_STATUS = 'ok', 'missing', 'empty', 'unreadable', 'bad columns', 'negative', 'out of bounds'  # read_label() codes
+
+
+def read_label(file):
+    # Returns the labels of one label file, its LABEL_STATUS index and whether it has duplicate rows
+    try:
+        with open(file, 'r') as f:
+            l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
+    except:
+        return np.zeros((0, 5), dtype=np.float32), 1 if not os.path.isfile(file) else 3, False  # missing or unreadable
+
+    if not l.shape[0]:
+        return l.reshape(-1, 5), 2, False
+    if l.ndim != 2 or l.shape[1] != 5:
+        return np.zeros((0, 5), dtype=np.float32), 4, False
+    status = 5 if (l < 0).any() else 6 if (l[:, 1:] > 1).any() else 0  # negative, non-normalized or out of bounds
+    return l, status, np.unique(l, axis=0).shape[0] < l.shape[0]
+
+
+def scan_labels(files, desc='Scanning labels'):
+    # read_label() of every file in a process pool, returns the labels, status and duplicate flags
+    with Pool(min(os.cpu_count(), 8)) as pool:
+        x = list(tqdm(pool.imap(read_label, files, chunksize=64), total=len(files), desc=desc))
+    return [l for l, _, _ in x], np.array([s for _, s, _ in x], dtype=np.int8), np.array([d for _, _, d in x], dtype=np.bool_)
+
+
+def label_report(labels, files, status, duplicate, bins=20):
+    # Dataset statistics: files per status, instances and images per class, histograms of normalized box sizes
+    l = np.concatenate(labels, 0) if len(labels) else np.zeros((0, 5), dtype=np.float32)
+    i = np.repeat(np.arange(len(labels)), [len(x) for x in labels])  # image index of each label
+    c = l[:, 0].astype(np.int64)
+    nc = c.max() + 1 if len(c) else 0
+    edges = np.linspace(0, 1, bins + 1)
+    return {'images': len(files),
+            'labels': len(l),
+            'files': {s: int((status == j).sum()) for j, s in enumerate(LABEL_STATUS)},
+            'duplicate': int(duplicate.sum()),
+            'class_instances': np.bincount(c, minlength=nc).tolist(),
+            'class_images': np.bincount(np.unique(i * nc + c) % nc if nc else c, minlength=nc).tolist(),
+            'box_bins': edges.tolist(),
+            'box_width': np.histogram(l[:, 3].clip(0, 1), edges)[0].tolist(),
+            'box_height': np.histogram(l[:, 4].clip(0, 1), edges)[0].tolist(),
+            'box_area': np.histogram((l[:, 3] * l[:, 4]).clip(0, 1) ** 0.5, edges)[0].tolist(),  # sqrt of area
+            'problems': {s: [f for f, x in zip(files, status) if x == j]
+                         for j, s in enumerate(LABEL_STATUS) if j and (status == j).any()},
+            'duplicates': [f for f, x in zip(files, duplicate) if x]}
+
+
+def load_labels(label_files, cache, report=None):
+    # Returns the labels of label_files (None if missing) and their duplicate row flags. Labels are kept in a binary
+    # cache (one float32 array plus per-file offsets), rebuilt when the list, mtimes or sizes of the label files change.
+    # Rebuilding validates the files in parallel and writes a label_report() json to report
+    files = sorted(set(label_files))
+    key = hashlib.sha1()
+    for file in files:
+        try:
+            st = os.stat(file)
+            key.update(('%s %d %d\n' % (file, st.st_mtime_ns, st.st_size)).encode())
+        except OSError:
+            key.update(('%s missing\n' % file).encode())
+    key = key.hexdigest()
+
+    try:
+        c = np.load(cache)
+        assert str(c['key']) == key, 'Label cache out of sync'
+        labels, offsets, status, duplicate = c['labels'], c['offsets'], c['status'], c['duplicate']
+        assert report is None or os.path.isfile(report), 'Label report missing'
+    except:
+        labels, status, duplicate = scan_labels(files, desc='Caching labels')
+        if report:
+            with open(report, 'w') as f:
+                json.dump(label_report(labels, files, status, duplicate), f, indent=1)
+        bad = np.flatnonzero(status >= 4)  # unreadable (ragged) files count as missing, as before
+        assert not len(bad), '%s labels in %g files, e.g. %s. See %s' % (
+            LABEL_STATUS[status[bad[0]]], len(bad), files[bad[0]], report or help_url)
+
+        offsets = np.cumsum([0] + [len(l) for l in labels])
+        labels = np.concatenate(labels, 0)
+        try:  # write to a temporary file and rename, concurrent readers never see a partial cache
+            f = cache + '.%g.tmp' % os.getpid()
+            with open(f, 'wb') as fp:
+                np.savez(fp, key=np.array(key), labels=labels, offsets=offsets, status=status, duplicate=duplicate)
+            os.replace(f, cache)
+        except OSError:
+            print('WARNING: can not write label cache %s' % cache)
+
+    index = {file: i for i, file in enumerate(files)}
+    j = [index[file] for file in label_files]
+    return [None if status[i] in (1, 3) else labels[offsets[i]:offsets[i + 1]] for i in j], duplicate[j]
+
+
+class ImageCache:
+    # Resized uint8 images in one memory-mapped file, read zero-copy by every process through the page cache
+    def __init__(self, path, offsets, hw, index):
+        self.path, self.offsets, self.hw, self.index = path, offsets, hw, index  # index: dataset index to cache slot
+        self.mm = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if self.mm is None:  # opened lazily in each DataLoader worker
+            self.mm = np.memmap(self.path, dtype=np.uint8, mode='r')
+        i = self.index[i]
+        return self.mm[self.offsets[i]:self.offsets[i + 1]].reshape(*self.hw[i], 3)
+
+    def __getstate__(self):  # never pickle the mapping itself
+        return {**self.__dict__, 'mm': None}
+
+
+def load_image_cache(self, cache):
+    # Returns an ImageCache of the dataset images resized as load_image() does, with original and resized hw.
+    # The cache (cache.bin pixels, cache.npz offsets and shapes) is rebuilt when the list, mtimes or sizes change
+    files = sorted(set(self.img_files))
+    key = hashlib.sha1(('%g %s\n' % (self.img_size, self.augment)).encode())
+    for file in files:
+        st = os.stat(file)
+        key.update(('%s %d %d\n' % (file, st.st_mtime_ns, st.st_size)).encode())
+    key = key.hexdigest()
+
+    try:
+        c = np.load(cache + '.npz')
+        assert str(c['key']) == key and os.path.getsize(cache + '.bin') == c['offsets'][-1], 'Image cache out of sync'
+        offsets, hw0, hw = c['offsets'], c['hw0'], c['hw']
+    except:
+        d = LoadImagesAndLabels.__new__(LoadImagesAndLabels)  # load_image() of the sorted files, without caching
+        d.img_files, d.imgs, d.img_size, d.augment = files, [None] * len(files), self.img_size, self.augment
+        offsets, hw0, hw = np.zeros(len(files) + 1, dtype=np.int64), np.zeros((len(files), 2), dtype=np.int64), \
+                           np.zeros((len(files), 2), dtype=np.int64)
+        f = cache + '.%g.tmp' % os.getpid()
+        with open(f, 'wb') as fp, ThreadPool(min(os.cpu_count(), 8)) as pool:  # decode in threads, write in order
+            pbar = tqdm(pool.imap(lambda i: load_image(d, i), range(len(files))), total=len(files), desc='Caching images')
+            for i, (img, hw0[i], hw[i]) in enumerate(pbar):
+                fp.write(np.ascontiguousarray(img).data)
+                offsets[i + 1] = offsets[i] + img.nbytes
+                pbar.desc = 'Caching images (%.1fGB)' % (offsets[i + 1] / 1E9)
+        os.replace(f, cache + '.bin')
+        with open(f, 'wb') as fp:
+            np.savez(fp, key=np.array(key), offsets=offsets, hw0=hw0, hw=hw)
+        os.replace(f, cache + '.npz')
+
+    index = {file: i for i, file in enumerate(files)}
+    j = np.array([index[file] for file in self.img_files])
+    return ImageCache(cache + '.bin', offsets, hw, j), [tuple(x) for x in hw0[j].tolist()], \
+           [tuple(x) for x in hw[j].tolist()]
+
 
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
-    if img is None:  # not cached
+    if img is None or img.ndim == 1:  # not cached, or encoded image bytes read from a shard
         img_path = self.img_files[index]
-        img = cv2.imread(img_path)  # BGR
+        img = cv2.imread(img_path) if img is None else cv2.imdecode(img, cv2.IMREAD_COLOR)  # BGR
         assert img is not None, 'Image Not Found ' + img_path
         h0, w0 = img.shape[:2]  # orig hw
         r = self.img_size / max(h0, w0)  # resize image to img_size
@@ -525,18 +1029,19 @@ def load_image(self, index):
 
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
     x = np.random.uniform(-1, 1, 3) * [hgain, sgain, vgain] + 1  # random gains
-    img_hsv = (cv2.cvtColor(img, cv2.COLOR_BGR2HSV) * x).clip(None, 255).astype(np.uint8)
-    np.clip(img_hsv[:, :, 0], None, 179, out=img_hsv[:, :, 0])  # inplace hue clip (0 - 179 deg)
+    lut = (np.arange(256)[:, None] * x).clip(None, 255).astype(np.uint8)  # gain lookup table per channel
+    np.clip(lut[:, 0], None, 179, out=lut[:, 0])  # hue clip (0 - 179 deg)
+    img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    cv2.LUT(img_hsv, lut.reshape(1, 256, 3), dst=img_hsv)  # same as (img_hsv * x).clip(None, 255).astype(np.uint8)
     cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR, dst=img)  # no return needed
 
 
 def load_mosaic(self, index):
-    # loads images in a mosaic
+    # loads images in a mosaic, each tile is warped by the random affine straight into the cropped output
 
-    labels4 = []
+    labels4, tiles = [], []
     s = self.img_size
     xc, yc = [int(random.uniform(s * 0.5, s * 1.5)) for _ in range(2)]  # mosaic center x, y
-    img4 = np.zeros((s * 2, s * 2, 3), dtype=np.uint8) + 128  # base image with 4 tiles
     indices = [index] + [random.randint(0, len(self.labels) - 1) for _ in range(3)]  # 3 additional image indices
     for i, index in enumerate(indices):
         # Load image
@@ -556,13 +1061,13 @@ def load_mosaic(self, index):
             x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
+        tiles.append((img[y1b:y2b, x1b:x2b], x1a, y1a))  # img4[y1a:y2a, x1a:x2a] of a 2s x 2s mosaic
         padw = x1a - x1b
         padh = y1a - y1b
 
         # Load labels
         label_path = self.label_files[index]
-        if os.path.isfile(label_path):
+        if self.labels[index] is not None or os.path.isfile(label_path):
             x = self.labels[index]
             if x is None:  # labels not preloaded
                 with open(label_path, 'r') as f:
@@ -585,14 +1090,19 @@ def load_mosaic(self, index):
         # np.clip(labels4[:, 1:] - s / 2, 0, s, out=labels4[:, 1:])  # use with center crop
         np.clip(labels4[:, 1:], 0, 2 * s, out=labels4[:, 1:])  # use with random_affine
 
-    # Augment
-    # img4 = img4[s // 2: int(s * 1.5), s // 2:int(s * 1.5)]  # center crop (WARNING, requires box pruning)
-    img4, labels4 = random_affine(img4, labels4,
-                                  degrees=self.hyp['degrees'] * 1,
-                                  translate=self.hyp['translate'] * 1,
-                                  scale=self.hyp['scale'] * 1,
-                                  shear=self.hyp['shear'] * 1,
-                                  border=-s // 2)  # border to remove
+    # Augment, random_affine() of the 2s x 2s mosaic with a border of s // 2 removed, done with one warp per tile
+    M = affine_matrix((s * 2, s * 2),
+                      degrees=self.hyp['degrees'] * 1,
+                      translate=self.hyp['translate'] * 1,
+                      scale=self.hyp['scale'] * 1,
+                      shear=self.hyp['shear'] * 1,
+                      border=-s // 2)  # border to remove
+    img4 = np.full((s, s, 3), 128, dtype=np.uint8)
+    for img, x, y in tiles:
+        T = np.eye(3)
+        T[:2, 2] = x, y  # tile position in the mosaic
+        warp_into(img4, img, M @ T)
+    labels4 = affine_labels(labels4, M, s, s)
 
     return img4, labels4
 
@@ -600,7 +1110,16 @@ def load_mosaic(self, index):
 def letterbox(img, new_shape=(416, 416), color=(128, 128, 128),
               auto=True, scaleFill=False, scaleup=True, interp=cv2.INTER_AREA):
     # Resize image to a 32-pixel-multiple rectangle https://github.com/ultralytics/yolov3/issues/232
-    shape = img.shape[:2]  # current shape [height, width]
+    new_unpad, ratio, (dw, dh), (top, bottom, left, right) = letterbox_shape(img.shape[:2], new_shape, auto, scaleFill,
+                                                                             scaleup)
+    if img.shape[1::-1] != new_unpad:  # resize
+        img = cv2.resize(img, new_unpad, interpolation=interp)  # INTER_AREA is better, INTER_LINEAR is faster
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
+    return img, ratio, (dw, dh)
+
+
+def letterbox_shape(shape, new_shape=(416, 416), auto=True, scaleFill=False, scaleup=True):
+    # Returns the resized wh, wh ratios, wh padding and top, bottom, left, right borders of letterbox() for shape hw
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
 
@@ -622,13 +1141,21 @@ def letterbox(img, new_shape=(416, 416), color=(128, 128, 128),
 
     dw /= 2  # divide padding into 2 sides
     dh /= 2
-
-    if shape[::-1] != new_unpad:  # resize
-        img = cv2.resize(img, new_unpad, interpolation=interp)  # INTER_AREA is better, INTER_LINEAR is faster
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
-    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
-    return img, ratio, (dw, dh)
+    return tuple(new_unpad), ratio, (dw, dh), (top, bottom, left, right)
+
+
+def letterbox_batch(imgs, new_shape=(416, 416), color=(128, 128, 128), auto=True, interp=cv2.INTER_AREA):
+    # letterbox() of images with a common output shape, resized straight into one n x h x w x 3 array
+    shapes = [letterbox_shape(x.shape[:2], new_shape, auto) for x in imgs]
+    (w, h), _, _, (top, bottom, left, right) = shapes[0]
+    out = np.empty((len(imgs), h + top + bottom, w + left + right, 3), dtype=np.uint8)
+    out[:] = color
+    for img, dst, ((w, h), _, _, (top, _, left, _)) in zip(imgs, out, shapes):
+        dst[top:top + h, left:left + w] = img if img.shape[1::-1] == (w, h) else \
+            cv2.resize(img, (w, h), interpolation=interp)
+    return out
 
 
 def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10, border=0):
@@ -640,17 +1167,29 @@ def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10,
     height = img.shape[0] + border * 2
     width = img.shape[1] + border * 2
 
+    M = affine_matrix(img.shape[:2], degrees, translate, scale, shear, border)
+    changed = (border != 0) or (M != np.eye(3)).any()
+    if changed:
+        img = cv2.warpAffine(img, M[:2], dsize=(width, height), flags=cv2.INTER_AREA, borderValue=(128, 128, 128))
+
+    return img, affine_labels(targets, M, width, height)
+
+
+def affine_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, border=0):
+    # Returns the random 3x3 affine matrix of random_affine() for an image of shape (height, width)
+    height, width = shape
+
     # Rotation and Scale
     R = np.eye(3)
     a = random.uniform(-degrees, degrees)
     # a += random.choice([-180, -90, 0, 90])  # add 90deg rotations to small rotations
     s = random.uniform(1 - scale, 1 + scale)
-    R[:2] = cv2.getRotationMatrix2D(angle=a, center=(img.shape[1] / 2, img.shape[0] / 2), scale=s)
+    R[:2] = cv2.getRotationMatrix2D(angle=a, center=(width / 2, height / 2), scale=s)
 
     # Translation
     T = np.eye(3)
-    T[0, 2] = random.uniform(-translate, translate) * img.shape[0] + border  # x translation (pixels)
-    T[1, 2] = random.uniform(-translate, translate) * img.shape[1] + border  # y translation (pixels)
+    T[0, 2] = random.uniform(-translate, translate) * height + border  # x translation (pixels)
+    T[1, 2] = random.uniform(-translate, translate) * width + border  # y translation (pixels)
 
     # Shear
     S = np.eye(3)
@@ -658,11 +1197,28 @@ def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10,
     S[1, 0] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # y shear (deg)
 
     # Combined rotation matrix
-    M = S @ T @ R  # ORDER IS IMPORTANT HERE!!
-    changed = (border != 0) or (M != np.eye(3)).any()
-    if changed:
-        img = cv2.warpAffine(img, M[:2], dsize=(width, height), flags=cv2.INTER_AREA, borderValue=(128, 128, 128))
-
+    return S @ T @ R  # ORDER IS IMPORTANT HERE!!
+
+
+def warp_into(dst, src, M):
+    # Warps src by the 3x3 affine M into dst in place, dst pixels outside of the warped src are left unchanged.
+    # Only the bounding box of the warped src is computed
+    h, w = src.shape[:2]
+    if not h or not w:
+        return
+    xy = M[:2] @ np.array([[-1, w, w, -1], [-1, -1, h, h], [1, 1, 1, 1]])  # warped corners, 1 pixel margin
+    x0, y0 = np.floor(xy.min(1)).clip(0).astype(int)
+    x1, y1 = np.ceil(xy.max(1)).astype(int) + 1
+    x1, y1 = min(x1, dst.shape[1]), min(y1, dst.shape[0])
+    if x0 < x1 and y0 < y1:
+        T = M[:2].copy()
+        T[:, 2] -= x0, y0  # into the bounding box
+        cv2.warpAffine(src, T, dsize=(x1 - x0, y1 - y0), dst=dst[y0:y1, x0:x1], flags=cv2.INTER_AREA,
+                       borderMode=cv2.BORDER_TRANSPARENT)
+
+
+def affine_labels(targets, M, width, height):
+    # Returns targets [cls, xyxy] transformed by the 3x3 affine M, clipped to width x height and filtered
     # Transform label coordinates
     n = len(targets)
     if n:
@@ -698,7 +1254,7 @@ def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10,
         targets = targets[i]
         targets[:, 1:5] = xy[i]
 
-    return img, targets
+    return targets
 
 
 def cutout(image, labels):
@@ -819,6 +1375,41 @@ def imagelist2folder(path='data/coco_64img.txt'):  # from utils.datasets import
             print(line)
 
 
+def convert_shards(path='data/coco2014.data', shard_size=1000):  # from utils.datasets import *; convert_shards()
+    # Packs the image lists of a *.data file (or one *.txt list) into <list>_shards/ for LoadShards(): tar shards of
+    # encoded image bytes, read sequentially, and index.npz with the shard names, image paths, shapes and labels
+    if path.endswith('.data'):
+        from utils.parse_config import parse_data_cfg
+        data = parse_data_cfg(path)
+        for x in 'train', 'valid':
+            convert_shards(data[x], shard_size)
+        return
+
+    with open(path, 'r') as f:
+        files = [x.replace('/', os.sep) for x in f.read().splitlines() if os.path.splitext(x)[-1].lower() in img_formats]
+    label_files = [x.replace('images', 'labels').replace(os.path.splitext(x)[-1], '.txt') for x in files]
+    labels, _ = load_labels(label_files, os.path.splitext(path)[0] + '.labels.npz', os.path.splitext(path)[0] + '.report.json')
+    labels = [np.zeros((0, 5), dtype=np.float32) if l is None else l for l in labels]
+    shapes = load_shapes(files, os.path.splitext(path)[0] + '.shapes.npz')
+
+    out = os.path.splitext(path)[0] + '_shards'
+    os.makedirs(out, exist_ok=True)
+    shards = []
+    for i in tqdm(range(0, len(files), shard_size), desc='Writing shards to %s' % out):
+        shards.append('%06d.tar' % (i // shard_size))
+        f = os.path.join(out, shards[-1])
+        with tarfile.open(f + '.tmp', 'w') as tar:
+            for j in range(i, min(i + shard_size, len(files))):
+                tar.add(files[j], arcname='%08d%s' % (j, os.path.splitext(files[j])[-1].lower()))  # image bytes as is
+        os.replace(f + '.tmp', f)
+
+    offsets = np.cumsum([0] + [len(l) for l in labels])
+    with open(os.path.join(out, 'index.tmp'), 'wb') as f:
+        np.savez(f, shards=np.array(shards), files=np.array(files), shapes=shapes, offsets=offsets,
+                 labels=np.concatenate(labels, 0).astype(np.float32).reshape(-1, 5))
+    os.replace(os.path.join(out, 'index.tmp'), os.path.join(out, 'index.npz'))
+
+
 def create_folder(path='./new_folder'):
     # Create folder
     if os.path.exists(path):
@@ -15,6 +15,7 @@ class weightedFeatureFusion(nn.Module):  # weighted sum of 2 or more layers http
             self.w = torch.nn.Parameter(torch.zeros(self.n))  # layer weights
 
     def forward(self, x, outputs):
+        # outputs are the features of self.layers, in the same order
         # Weights
         if self.weight:
             w = torch.sigmoid(self.w) * (2 / self.n)  # sigmoid weights (0-1)
@@ -23,7 +24,7 @@ class weightedFeatureFusion(nn.Module):  # weighted sum of 2 or more layers http
         # Fusion
         nc = x.shape[1]  # input of channels
         for i in range(self.n - 1):
-            a = outputs[self.layers[i]] * w[i + 1] if self.weight else outputs[self.layers[i]]  # feature to add
+            a = outputs[i] * w[i + 1] if self.weight else outputs[i]  # feature to add
             ac = a.shape[1] # feature channels
             dc = nc - ac # delta channels
 
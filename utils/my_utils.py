@@ -16,6 +16,10 @@ def create_train_argparser():
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, help='gsutil bucket')
     parser.add_argument('--cache_images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--batch_augment', action='store_true', help='flip and hsv augment whole batches on device')
+    parser.add_argument('--collate_ring', action='store_true', help='collate into reusable shared, pinned buffers, '
+                        'workers x 4 x largest batch bytes of page-locked memory')
+    parser.add_argument('--img_weights', action='store_true', help='select training images by weight')
     parser.add_argument('--cache_labels', action='store_true', help='cache labels for faster training')
     parser.add_argument('--weights', type=str, help='initial weights')
     parser.add_argument('--arc', type=str, help='yolo architecture')  # default, uCE, uBCE
@@ -72,6 +76,10 @@ def create_test_argparser():
     parser.add_argument('--mask', action='store_true', help='wheter has a mask inside the checkpoint')
     parser.add_argument('--mask_weight', type=str, default=None, help='wheter mask is another checkpoint')
     parser.add_argument('--architecture', type=str, default='default', help='default or soft')
+    parser.add_argument('--topk_per_image', type=int, default=None, help='best candidates per image kept before NMS')
+    parser.add_argument('--topk_per_class', type=int, default=None, help='best candidates per image and class kept before NMS')
+    parser.add_argument('--max_det', type=int, default=None, help='maximum detections per image after NMS')
+    parser.add_argument('--pipeline', action='store_true', help='overlap inference, NMS and statistics in threads')
     args = vars(parser.parse_args())
 
     pieces = args['weights'].split('/')
@@ -101,6 +109,11 @@ def create_prune_argparser():
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, help='gsutil bucket')
     parser.add_argument('--cache_images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--batch_augment', action='store_true', help='flip and hsv augment whole batches on device')
+    parser.add_argument('--mask_grads', action='store_true', help='keep pruned weights at zero by masking gradients')
+    parser.add_argument('--collate_ring', action='store_true', help='collate into reusable shared, pinned buffers, '
+                        'workers x 4 x largest batch bytes of page-locked memory')
+    parser.add_argument('--img_weights', action='store_true', help='select training images by weight')
     parser.add_argument('--cache_labels', action='store_true', help='cache labels for faster training')
     parser.add_argument('--weights', type=str, help='initial weights')
     parser.add_argument('--arc', type=str, help='yolo architecture')  # default, uCE, uBCE
@@ -168,6 +181,10 @@ def create_kd_argparser():
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, help='gsutil bucket')
     parser.add_argument('--cache_images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--batch_augment', action='store_true', help='flip and hsv augment whole batches on device')
+    parser.add_argument('--collate_ring', action='store_true', help='collate into reusable shared, pinned buffers, '
+                        'workers x 4 x largest batch bytes of page-locked memory')
+    parser.add_argument('--img_weights', action='store_true', help='select training images by weight')
     parser.add_argument('--cache_labels', action='store_true', help='cache labels for faster training')
     parser.add_argument('--teacher_weights', type=str, help='initial teacher weights')
     parser.add_argument('--student_weights', type=str, help='initial student weights')
@@ -424,7 +441,7 @@ def create_dataloaders(config):
     import os
     from torch.utils.data import DataLoader
     from utils.parse_config import parse_data_cfg
-    from utils.datasets import LoadImagesAndLabels
+    from utils.datasets import LoadImagesAndLabels, LoadShards, ImageWeightSampler
 
     data = config['data']
     img_size, img_size_test = config['img_size'] if len(config['img_size']) == 2 else config['img_size'] * 2  # train, test sizes
@@ -436,29 +453,50 @@ def create_dataloaders(config):
     valid_path = data_dict['valid']
 
     # Dataset
-    dataset = LoadImagesAndLabels(
-        train_path, img_size, batch_size,
-        augment=True, hyp=config['hyp'],  cache_labels=config['cache_labels'],# augmentation hyperparameters
-        cache_images=config['cache_images'],
-    )
+    if os.path.isdir(train_path):  # shards from convert_shards(), read sequentially through a shuffle buffer
+        assert not config['img_weights'], '--img_weights needs an image list, shards are read in order: %s' % train_path
+        dataset = LoadShards(
+            train_path, img_size, batch_size,
+            augment=True, hyp=config['hyp'], batch_augment=config['batch_augment'],
+        )
+    else:
+        dataset = LoadImagesAndLabels(
+            train_path, img_size, batch_size,
+            augment=True, hyp=config['hyp'],  cache_labels=config['cache_labels'],# augmentation hyperparameters
+            cache_images=config['cache_images'], batch_augment=config['batch_augment'],
+            image_weights=config['img_weights'],
+        )
 
     # Dataloader
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, 8])  # number of workers
+    sampler = ImageWeightSampler(len(dataset)) if dataset.image_weights else None
+    if sampler is not None and config.get('sampler') is not None:  # set by load_checkpoints*() on --resume
+        sampler.load_state_dict(config['sampler'])  # continue the weighted sample sequence
+    prefetch = {'prefetch_factor': 2} if nw else {}  # batches in flight per worker, also sizes the collate ring
     trainloader = DataLoader(
-        dataset, batch_size = batch_size, num_workers = nw,
-        pin_memory = True, collate_fn = dataset.collate_fn
+        dataset, batch_size = batch_size, sampler = sampler, num_workers = nw, pin_memory = True, **prefetch,
+        collate_fn = dataset.collate_ring(batch_size, nw, **prefetch) if config['collate_ring'] else dataset.collate_fn
     )
 
     # Testloader
-    validloader = DataLoader(
-        LoadImagesAndLabels(
+    if os.path.isdir(valid_path):
+        print('WARNING: validating on shards in %s with square %g images, not rectangular batches' % (valid_path, img_size_test))
+        validset = LoadShards(valid_path, img_size_test, batch_size, hyp = config['hyp'])
+    else:
+        validset = LoadImagesAndLabels(
             valid_path, img_size_test, batch_size,
             hyp = config['hyp'], rect = True, cache_labels = config['cache_labels'],
             cache_images = False
-        ),
-        batch_size = batch_size, num_workers = nw, pin_memory = True, collate_fn = dataset.collate_fn
+        )
+    validloader = DataLoader(
+        validset, batch_size = batch_size, num_workers = nw, pin_memory = True, **prefetch,
+        collate_fn = validset.collate_ring(batch_size, nw, **prefetch) if config['collate_ring'] else dataset.collate_fn
     )
+    for loader in (trainloader, validloader):  # a worker must never refill a ring slot still in use
+        assert not (config['collate_ring'] and nw) or loader.prefetch_factor == loader.collate_fn.prefetch, \
+            'DataLoader prefetch_factor %s and collate ring prefetch %s differ' % (
+                loader.prefetch_factor, loader.collate_fn.prefetch)
 
     return trainloader, validloader
 
@@ -530,6 +568,7 @@ def load_checkpoints(config, model, optimizer, device, try_download_function, da
                 with open(config['results_file'], 'w') as file:
                     file.write(chkpt['training_results'])  # write results.txt
 
+            config['sampler'] = chkpt.get('sampler')  # image-weight sampler state, for create_dataloaders()
             start_epoch = chkpt['epoch'] + 1
         del chkpt
         torch.cuda.empty_cache()
@@ -578,6 +617,7 @@ def load_checkpoints_mask(config, model, mask, optimizer, device, try_download_f
                 with open(config['results_file'], 'w') as file:
                     file.write(chkpt['training_results'])  # write results.txt
 
+            config['sampler'] = chkpt.get('sampler')  # image-weight sampler state, for create_dataloaders()
             try:
                 start_iteration = chkpt['iteration']
             except:
@@ -683,6 +723,7 @@ def load_kd_checkpoints(config, teacher, student, mask, another_model, optimizer
                 with open(config['results_file'], 'w') as file:
                     file.write(chkpt['training_results'])  # write results.txt
 
+            config['sampler'] = chkpt.get('sampler')  # image-weight sampler state, for create_dataloaders()
             start_epoch = chkpt['epoch'] + 1
         del chkpt
         torch.cuda.empty_cache()
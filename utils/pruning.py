@@ -1,4 +1,6 @@
+import os
 import math
+import weakref
 import torch
 import numpy as np
 import torch.nn as nn
@@ -18,29 +20,132 @@ def create_backup(model):
     return nn.ParameterDict(backup)
 
 
+class WeightSnapshot:
+    # The model state_dict written once to one flat file (path.bin, index in path.npz) and read back memory-mapped.
+    # keys()/values() as create_backup(), rewind_weights() copies it straight into the live tensors page by page
+    def __init__(self, path, model=None):
+        self.path, self.mm = path, None
+        if model is not None:
+            names, dtypes, dims, offsets = [], [], [], [0]
+            with open(path + '.bin.tmp', 'wb') as f:
+                for name, t in model.state_dict().items():  # one tensor at a time on the CPU
+                    b = t.detach().cpu().contiguous().numpy().tobytes()
+                    f.write(b + bytes(-len(b) % 64))  # 64 byte aligned views
+                    names.append(name), dtypes.append(str(t.dtype).split('.')[-1]), dims.append(t.shape)
+                    offsets.append(offsets[-1] + len(b) + -len(b) % 64)
+            with open(path + '.npz.tmp', 'wb') as f:
+                np.savez(f, names=np.array(names), dtypes=np.array(dtypes), ndim=[len(d) for d in dims],
+                         shape=np.array([n for d in dims for n in d], dtype=np.int64), offsets=offsets)
+            os.replace(path + '.bin.tmp', path + '.bin')
+            os.replace(path + '.npz.tmp', path + '.npz')
+        c = np.load(path + '.npz')
+        self.names, self.dtypes, self.offsets = list(c['names']), list(c['dtypes']), c['offsets']
+        self.shapes = np.split(c['shape'], np.cumsum(c['ndim'])[:-1])
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return self.names
+
+    def values(self):
+        if self.mm is None:  # copy-on-write mapping, never written, pages are read on demand
+            self.mm = np.memmap(self.path + '.bin', dtype=np.uint8, mode='c')
+        for i, (dtype, shape) in enumerate(zip(self.dtypes, self.shapes)):
+            yield torch.from_numpy(self.mm[self.offsets[i]:self.offsets[i + 1]]).view(getattr(torch, dtype))[
+                :int(np.prod(shape))].view(tuple(shape.tolist()))
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def __getstate__(self):  # never pickle the mapping itself
+        return {**self.__dict__, 'mm': None}
+
+
 def rewind_weights(model, backup):
+    state = model.state_dict()  # references to the model tensors, built once
+    dst = [state[name.replace('-', '.')] for name in backup.keys()] # Changing to the original key
     with torch.no_grad():
-        for name, param in backup.items():
-            name_ = name.replace('-', '.') # Changing to the original key
-            model.state_dict()[name_].data.copy_( param )
+        for d, s in zip(dst, backup.values()):
+            d.copy_(s)
 
 
 def sum_of_the_weights(item):
-    count = 0
-    for name in item.state_dict():
-        count += torch.sum(torch.abs(item.state_dict()[name].data))
-    
-    return count
+    return sum(v.abs().sum() for v in list(item.parameters()) + list(item.buffers())) # not state_dict(), masks save packed
+
+
+@torch.no_grad()
+def global_threshold(scores, k, masks=None, score_fn=None):
+    # Returns the k-th smallest of the scores over all tensors (only where masks != 0), as kthvalue() of their
+    # concatenation, without building it. A radix pass counts the scores by their top 16 float bits, kthvalue() then
+    # runs on the one bucket holding the k-th value. score_fn (e.g. torch.abs) is applied to each tensor on the fly
+    def buckets(i):  # flat scores of tensor i and their order-preserving top 16 bits, 65536 where masked out
+        s = (score_fn(scores[i]) if score_fn else scores[i]).detach().float().flatten()
+        b = s.view(torch.int32)
+        b = ((b ^ ((b >> 31) & 0x7fffffff)) >> 16) + 32768  # flip negative floats so bits sort as the values
+        if masks is not None:
+            b.masked_fill_(masks[i].flatten() == 0, 65536)
+        return s, b.long()
+
+    device = scores[0].device
+    hist = sum(torch.bincount(buckets(i)[1], minlength=65537).to(device) for i in range(len(scores)))[:65536]
+    cum = hist.cumsum(0)
+    j = int(torch.searchsorted(cum, torch.tensor([k], device=device)))  # bucket of the k-th score
+    below = int(cum[j] - hist[j])  # scores in lower buckets
+    bucket = torch.cat([s[b == j].to(device) for s, b in map(buckets, range(len(scores)))])
+    return torch.kthvalue(bucket, k - below).values.item()
+
+
+_bindings = weakref.WeakKeyDictionary()  # mask: (model weakref, its mask tensors, (module, name) of each weight)
+_grad_hooks = weakref.WeakKeyDictionary()  # mask: gradient hook handles of mask_gradients_LTH()
+
+
+def mask_bindings(model, mask):
+    # Returns the (masks, params) lists of a LTH mask and the model parameters it covers. Names are resolved once per
+    # model and mask, kept outside both. Parameters are read from their modules on each call, so they never go stale
+    b = _bindings.get(mask)
+    masks = list(mask.values())
+    if b is None or b[0]() is not model or len(b[1]) != len(masks) or any(x is not y for x, y in zip(b[1], masks)):
+        modules = dict(model.named_modules())
+        owners = [name.rpartition('-') for name in mask.keys()]  # Changing to the original key
+        b = weakref.ref(model), masks, [(modules[m.replace('-', '.')], p) for m, _, p in owners]
+        _bindings[mask] = b
+    return b[1], [m._parameters[p] for m, p in b[2]]
 
 
 ##############################
 # Lottery Tickets Hypothesis #
 ##############################
+@torch.no_grad()
 def apply_mask_LTH(model, mask):
-    with torch.no_grad():
-        for name, param in mask.items():
-            name_ = name.replace('-', '.') # Changing to the original key
-            model.state_dict()[name_].data.copy_( model.state_dict()[name_].data.mul(param.data) )
+    masks, params = mask_bindings(model, mask)
+    torch._foreach_mul_(params, masks)
+
+
+def mask_gradients_LTH(model, mask, optimizer=None): # Alternative to apply_mask_LTH() before every step
+    # Zeroes the pruned weights and their optimizer state once, and hooks their gradients so they stay at zero through
+    # SGD (with momentum and weight decay) and Adam steps. Call it again whenever the mask or the optimizer change
+    apply_mask_LTH(model, mask)
+    masks, params = mask_bindings(model, mask)
+    if optimizer is not None:
+        with torch.no_grad():
+            for m, p in zip(masks, params):
+                for v in optimizer.state.get(p, {}).values():  # momentum, Adam moments
+                    if torch.is_tensor(v) and v.shape == p.shape:
+                        v.mul_(m)
+
+    for h in _grad_hooks.pop(mask, []):
+        h.remove()
+    _grad_hooks[mask] = [p.register_hook(lambda g, m=m: g * m) for m, p in zip(masks, params)]
+
+
+def assert_sparsity_LTH(model, mask):
+    # Raises if any weight pruned by mask is non-zero, returns the number of pruned and prunable weights
+    masks, params = mask_bindings(model, mask)
+    pruned = [m == 0 for m in masks]
+    changed = [name for name, z, p in zip(mask.keys(), pruned, params) if p.detach()[z].any()]
+    assert not changed, 'Pruned weights are non-zero in %s' % ', '.join(changed)
+    return sum(int(z.sum()) for z in pruned), sum(m.numel() for m in masks)
 
 
 def create_mask_LTH(model): # Create mask as Lottery Tickets Hypothesis
@@ -53,60 +158,93 @@ def create_mask_LTH(model): # Create mask as Lottery Tickets Hypothesis
             name_ = name.replace('.', '-') # ParameterDict and ModuleDict does not allows '.' as key
             mask[name_] = nn.Parameter( torch.ones_like(param), requires_grad = False )
 
-    return nn.ParameterDict(mask)
-
-
+    mask = nn.ParameterDict(mask)
+    # state_dict() packs the masks, load_state_dict() takes both packed and old full float masks
+    mask._register_state_dict_hook(pack_mask_hook)
+    mask._register_load_state_dict_pre_hook(unpack_mask_hook)
+    return mask
+
+
+def pack_mask_hook(module, state, prefix, local_metadata):  # module level, masks stay picklable
+    state.update(pack_mask({k: v for k, v in state.items() if k.startswith(prefix)}))
+
+
+def unpack_mask_hook(state, prefix, *args):
+    state.update(unpack_mask({k: v for k, v in state.items() if k.startswith(prefix)}))
+
+
+def pack_mask(state):
+    # Returns the 0/1 mask tensors of a state_dict as {'shape', 'bits'} packed bitsets (1 bit per weight), or as
+    # {'shape', 'index'} int32 indices of the kept weights when fewer than 1/32 are kept. Packed entries pass through
+    packed = type(state)()
+    for k, v in state.items():
+        if isinstance(v, dict): packed[k] = v; continue
+        keep = v.detach().cpu().flatten().numpy() != 0
+        if np.count_nonzero(keep) * 32 < keep.size:
+            packed[k] = {'shape': tuple(v.shape), 'index': torch.from_numpy(np.flatnonzero(keep).astype(np.int32))}
+        else:
+            packed[k] = {'shape': tuple(v.shape), 'bits': torch.from_numpy(np.packbits(keep))}
+    return packed
+
+
+def unpack_mask(state):
+    # Inverse of pack_mask(), returns float 0/1 mask tensors. Full tensors of old mask files pass through
+    unpacked = type(state)()
+    for k, v in state.items():
+        if not isinstance(v, dict): unpacked[k] = v; continue
+        n = int(np.prod(v['shape']))
+        if 'bits' in v:
+            keep = np.unpackbits(v['bits'].cpu().numpy(), count=n)
+        else:
+            keep = np.zeros(n, dtype=np.uint8)
+            keep[v['index'].cpu().numpy()] = 1
+        unpacked[k] = torch.from_numpy(keep.astype(np.float32)).view(v['shape'])
+    return unpacked
+
+
+def convert_mask_file(path, out=None):
+    # Rewrites an old mask_*.pt file or checkpoint (full float masks in 'mask') with packed masks
+    # from utils.pruning import *; import glob; [convert_mask_file(f) for f in glob.glob('weights/**/*.pt', recursive=True)]
+    import os
+    ckpt = torch.load(path, map_location='cpu')
+    if isinstance(ckpt, dict) and isinstance(ckpt.get('mask'), dict): ckpt['mask'] = pack_mask(ckpt['mask'])
+    elif isinstance(ckpt, dict) and all(k.endswith('-weight') for k in ckpt): ckpt = pack_mask(ckpt)
+    else: return  # no LTH mask inside
+    out = out or path
+    torch.save(ckpt, out + '.tmp')
+    os.replace(out + '.tmp', out)  # atomic, an interrupted conversion keeps the old file
+
+
+@torch.no_grad()
 def IMP_LOCAL(model, mask, percentage_of_pruning): # Implements Lottery Tickets Hypothesis locally
-    nc = (model.module_defs[-1]['classes'] + 5) * 3
-    for name, param in model.named_parameters():
-        conv_before_yolo = 'PEP' not in name and param.shape[0] == nc
-        if not conv_before_yolo and 'bias' not in name and 'bn' not in name and 'BatchNorm' not in name:
-            name_ = name.replace('.', '-') # ParameterDict and ModuleDict does not allows '.' as key
-            # Locally number of neurons to be prunned
-            n_pruned_neurons = math.floor(torch.sum(mask[name_]) * percentage_of_pruning)
-            # Getting all the available values to possibly be pruned
-            valid_values = torch.masked_select(param, mask[name_].data.byte())
-            # Getting the values to be prunned.
-            smallest_values = torch.topk(input=torch.abs(valid_values), k=n_pruned_neurons, largest=False)
-            # Getting the higher valid value to be prune.
-            # All non-zero elements smaller than higher_of_smallest
-            # will be pruned.
-            higher_of_smallest = smallest_values.values[-1]
-            # Create the new mask
-            with torch.no_grad():
-                mask[name_] = torch.nn.Parameter( 
-                    torch.where(torch.abs(param) <= higher_of_smallest, torch.tensor(.0, device='cuda'), mask[name_]) 
-                )
-
-
+    for m, param in zip(*mask_bindings(model, mask)):
+        # Locally number of neurons to be prunned
+        n_pruned_neurons = math.floor(torch.sum(m) * percentage_of_pruning)
+        if n_pruned_neurons < 1: continue
+        # Getting all the available values to possibly be pruned
+        valid_values = torch.masked_select(param, m.bool())
+        # Getting the higher valid value to be prune.
+        # All non-zero elements smaller than higher_of_smallest
+        # will be pruned.
+        higher_of_smallest = torch.kthvalue(valid_values.abs(), n_pruned_neurons).values
+        # Update the mask in place, its bindings stay valid
+        m.masked_fill_(param.abs() <= higher_of_smallest, 0.)
+
+
+@torch.no_grad()
 def IMP_GLOBAL(model, mask, percentage_of_pruning): # Implements Lottery Tickets Hypothesis globally
-    valid_values = torch.Tensor(0).cuda()
-    nc = (model.module_defs[-1]['classes'] + 5) * 3
-    for name, param in model.named_parameters():
-        conv_before_yolo = 'PEP' not in name and param.shape[0] == nc
-        if not conv_before_yolo and 'bias' not in name and 'bn' not in name and 'BatchNorm' not in name:
-            name_ = name.replace('.', '-') # ParameterDict and ModuleDict does not allows '.' as key
-            # Getting all the available values to possibly be pruned
-            valid_values = torch.cat( ( valid_values, torch.masked_select(param, mask[name_].data.byte()) ) )
-    
+    masks, params = mask_bindings(model, mask)
     # Globally number of neurons to be prunned
-    n_pruned_neurons = math.floor(valid_values.shape[0] * percentage_of_pruning)
-    # Getting the values to be prunned.
-    smallest_values = torch.topk(input=torch.abs(valid_values), k=n_pruned_neurons, largest=False)
+    n_pruned_neurons = math.floor(sum(int(m.count_nonzero()) for m in masks) * percentage_of_pruning)
+    if n_pruned_neurons < 1: return
     # Getting the higher valid value to be prune.
     # All non-zero elements smaller than higher_of_smallest
     # will be pruned.
-    higher_of_smallest = smallest_values.values[-1]
+    higher_of_smallest = global_threshold(params, n_pruned_neurons, masks, torch.abs)
 
-    for name, param in model.named_parameters():
-        conv_before_yolo = 'PEP' not in name and param.shape[0] == nc
-        if not conv_before_yolo and 'bias' not in name and 'bn' not in name and 'BatchNorm' not in name:
-            name_ = name.replace('.', '-') # ParameterDict and ModuleDict does not allows '.' as key
-            # Create the new mask
-            with torch.no_grad():
-                mask[name_] = torch.nn.Parameter( 
-                    torch.where(torch.abs(param) <= higher_of_smallest, torch.tensor(.0, device='cuda'), mask[name_]) 
-                )
+    # Update the masks in place, their bindings stay valid
+    for m, param in zip(masks, params):
+        m.masked_fill_(param.abs() <= higher_of_smallest, 0.)
 
 
 #############################
@@ -176,15 +314,12 @@ class Pruner:
         #     score[mask == 0.0] = -np.inf
 
         # Threshold scores
-        global_scores = torch.cat([torch.flatten(v) for v in self.scores.values()])
-        k = int((1.0 - sparsity) * global_scores.numel())
+        k = int((1.0 - sparsity) * sum(v.numel() for v in self.scores.values()))
         if not k < 1:
-            threshold, _ = torch.kthvalue(global_scores, k)
+            threshold = global_threshold(list(self.scores.values()), k)
             for mask, param in self.masked_parameters:
                 score = self.scores[id(param)] 
-                zero = torch.tensor([0.]).to(mask.device)
-                one = torch.tensor([1.]).to(mask.device)
-                mask.copy_(torch.where(score <= threshold, zero, one))
+                mask.copy_(score > threshold)
     
     def _local_mask(self, sparsity):
         r"""Updates masks of model with scores by sparsity level parameter-wise.
@@ -194,9 +329,7 @@ class Pruner:
             k = int((1.0 - sparsity) * score.numel())
             if not k < 1:
                 threshold, _ = torch.kthvalue(torch.flatten(score), k)
-                zero = torch.tensor([0.]).to(mask.device)
-                one = torch.tensor([1.]).to(mask.device)
-                mask.copy_(torch.where(score <= threshold, zero, one))
+                mask.copy_(score > threshold)
 
     def mask(self, sparsity, scope):
         r"""Updates masks of model with scores by sparsity according to scope.
@@ -67,8 +67,9 @@ def labels_to_class_weights(labels, nc=80):
 def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80)):
     # Produces image weights based on class mAPs
     n = len(labels)
-    class_counts = np.array([np.bincount(labels[i][:, 0].astype(np.int), minlength=nc) for i in range(n)])
-    image_weights = (class_weights.reshape(1, nc) * class_counts).sum(1)
+    i = np.repeat(np.arange(n), [len(x) for x in labels])  # image index of each label
+    c = np.concatenate([x[:, 0] for x in labels]).astype(np.int64) if n else np.zeros(0, dtype=np.int64)  # label classes
+    image_weights = np.bincount(i, weights=np.asarray(class_weights).reshape(nc)[c], minlength=n)
     # index = random.choices(range(n), weights=image_weights, k=1)  # weight image sample
     return image_weights
 
@@ -213,6 +214,58 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
     return p, r, ap, f1, unique_classes.astype('int32')
 
 
+class APAccumulator:
+    # Streaming ap_per_class(): predictions are binned per class into fixed confidence histograms as they arrive,
+    # so memory is independent of the dataset size and compute() can be read at any point of an evaluation
+    def __init__(self, nc, niou=1, bins=1000):
+        self.nc, self.bins = nc, bins
+        self.tp = np.zeros((nc, bins, niou), dtype=np.int64)  # true positives per class, confidence bin, iou threshold
+        self.n_p = np.zeros((nc, bins), dtype=np.int64)  # predictions per class, confidence bin
+        self.n_gt = np.zeros(nc, dtype=np.int64)  # ground truth objects per class
+        self.seen = 0  # updates
+
+    def update(self, tp, conf, pred_cls, target_cls):
+        # Adds the (correct, conf, pcls, tcls) statistics of one image, same arguments as ap_per_class()
+        tp, conf, pred_cls = np.asarray(tp), np.asarray(conf, dtype=np.float64), np.asarray(pred_cls).astype(np.int64)
+        i = pred_cls < self.nc  # classes without targets can not change AP
+        c, b = pred_cls[i], np.clip((conf[i] * self.bins).astype(np.int64), 0, self.bins - 1)
+        np.add.at(self.n_p, (c, b), 1)
+        np.add.at(self.tp, (c, b), tp[i])
+        self.n_gt += np.bincount(np.asarray(target_cls).astype(np.int64), minlength=self.nc)[:self.nc]
+        self.seen += 1
+
+    def compute(self, pr_score=0.5):
+        # Returns p, r, ap, f1, unique_classes as ap_per_class(), with curve points at the confidence bins
+        unique_classes = np.nonzero(self.n_gt)[0]
+        conf = (np.arange(self.bins)[::-1] + 0.5) / self.bins  # bin centers, descending
+        s = [len(unique_classes), self.tp.shape[2]]  # number class, number iou thresholds
+        ap, p, r = np.zeros(s), np.zeros(s), np.zeros(s)
+        for ci, c in enumerate(unique_classes):
+            n_p = self.n_p[c, ::-1]
+            i = n_p > 0  # non-empty bins
+            if not i.any():
+                continue
+
+            # Accumulate FPs and TPs
+            tpc = self.tp[c, ::-1][i].cumsum(0)
+            fpc = n_p[i].cumsum(0)[:, None] - tpc
+
+            # Recall and precision at pr_score
+            recall = tpc / (self.n_gt[c] + 1e-16)  # recall curve
+            precision = tpc / (tpc + fpc)  # precision curve
+            r[ci] = np.interp(-pr_score, -conf[i], recall[:, 0])
+            p[ci] = np.interp(-pr_score, -conf[i], precision[:, 0])
+
+            # AP from recall-precision curve
+            for j in range(s[1]):
+                ap[ci, j] = compute_ap(recall[:, j], precision[:, j])
+
+        # Compute F1 score (harmonic mean of precision and recall)
+        f1 = 2 * p * r / (p + r + 1e-16)
+
+        return p, r, ap, f1, unique_classes.astype('int32')
+
+
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rbgirshick/py-faster-rcnn.
@@ -616,9 +669,11 @@ def build_targets(model, targets):
     return tcls, tbox, indices, av
 
 
-def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, multi_label=True, classes=None, agnostic=False):
+def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, multi_label=True, classes=None, agnostic=False,
+                        topk_per_image=None, topk_per_class=None, max_det=None):
     """
-    Performs  Non-Maximum Suppression on inference results
+    Performs  Non-Maximum Suppression on inference results, with a single batched nms over all images
+    Optionally keeps only the topk_per_image / topk_per_class best candidates before nms and max_det after it
     Returns detections with shape:
         nx6 (x1, y1, x2, y2, conf, cls)
     """
@@ -626,70 +681,117 @@ def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, multi_label=T
     # Settings
     merge = True  # merge for best mAP
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    time_limit = 10.0  # seconds to quit after
 
-    t = time.time()
+    bs = len(prediction)  # prediction is a (bs, n, no) tensor or a list of per-image tensors
     nc = prediction[0].shape[1] - 5  # number of classes
     multi_label &= nc > 1  # multiple labels per box
-    output = [None] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        x = x[x[:, 4] > conf_thres]  # confidence
-        x = x[((x[:, 2:4] > min_wh) & (x[:, 2:4] < max_wh)).all(1)]  # width-height
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[..., 5:] *= x[..., 4:5]  # conf = obj_conf * cls_conf
+    output = [None] * bs
 
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero().t()
-            x = torch.cat((box[i], x[i, j + 5].unsqueeze(1), j.float().unsqueeze(1)), 1)
-        else:  # best class only
-            conf, j = x[:, 5:].max(1)
-            x = torch.cat((box, conf.unsqueeze(1), j.float().unsqueeze(1)), 1)[conf > conf_thres]
-
-        # Filter by class
-        if classes:
-            x = x[(j.view(-1, 1) == torch.tensor(classes, device=j.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
+    # Gather candidates of all images, b is the image index of each row
+    if isinstance(prediction, torch.Tensor):
+        b, k = (prediction[..., 4] > conf_thres).nonzero().t()  # confidence
+        x = prediction[b, k]
+    else:
+        x = torch.cat(prediction, 0)
+        b = torch.repeat_interleave(torch.arange(bs, device=x.device),
+                                    torch.tensor([len(p) for p in prediction], device=x.device))
+        k = x[:, 4] > conf_thres  # confidence
+        x, b = x[k], b[k]
+    k = ((x[:, 2:4] > min_wh) & (x[:, 2:4] < max_wh)).all(1)  # width-height
+    x, b = x[k], b[k]
+
+    # If none remain there are no detections
+    if not x.shape[0]:
+        return output
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero().t()
+        x, b = torch.cat((box[i], x[i, j + 5].unsqueeze(1), j.float().unsqueeze(1)), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1)
+        k = conf > conf_thres
+        x, b = torch.cat((box, conf.unsqueeze(1), j.float().unsqueeze(1)), 1)[k], b[k]
+
+    # Filter by class
+    if classes:
+        k = (x[:, 5:6] == torch.tensor(classes, device=x.device, dtype=x.dtype)).any(1)
+        x, b = x[k], b[k]
+
+    # If none remain there are no detections
+    if not x.shape[0]:
+        return output
+
+    # Top-k candidates per class, then per image
+    if topk_per_class:
+        k = rank_in_group(x[:, 4], b * nc + x[:, 5].long()) < topk_per_class
+        x, b = x[k], b[k]
+    if topk_per_image:
+        k = rank_in_group(x[:, 4], b) < topk_per_image
+        x, b = x[k], b[k]
+    n = torch.bincount(b, minlength=bs)  # boxes per image
+
+    # Batched NMS over the whole batch, one group per (image, class)
+    g = b if agnostic else b * nc + x[:, 5].long()  # groups
+    scores = x[:, 4]
+    i = torchvision.ops.boxes.batched_nms(x[:, :4], scores, g, iou_thres)
+    if max_det:  # limit detections per image
+        i = i[rank_in_group(scores[i], b[i]) < max_det]
+    if merge:  # Merge NMS (boxes merged using weighted mean)
+        m = i[(n[b[i]] > 1) & (n[b[i]] < 3E3)]  # kept boxes of images with 1 < n < 3E3, as per image merge
+        if len(m):
+            x[m, :4] = merge_boxes(x[:, :4], scores, g, m, iou_thres)
+
+    # Split kept boxes by image, nms order (descending conf) is preserved within each image
+    b, k = b[i].sort(stable=True)
+    for xi, x in enumerate(x[i[k]].split(torch.bincount(b, minlength=bs).tolist())):
+        if len(x):
+            output[xi] = x
 
-        # If none remain process next image
-        n = x.shape[0]  # number of boxes
-        if not n:
-            continue
+    return output
 
-        # Sort by confidence
-        # x = x[x[:, 4].argsort(descending=True)]
-
-        # Batched NMS
-        c = x[:, 5] * 0 if agnostic else x[:, 5]  # classes
-        boxes, scores = x[:, :4].clone() + c.view(-1, 1) * max_wh, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.boxes.nms(boxes, scores, iou_thres)
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            try:  # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-                iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-                weights = iou * scores[None]  # box weights
-                x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-                # i = i[iou.sum(1) > 1]  # require redundancy
-            except:  # possible CUDA error https://github.com/ultralytics/yolov3/issues/1139
-                print(x, i, x.shape, i.shape)
-                pass
-
-        output[xi] = x[i]
-        if (time.time() - t) > time_limit:
-            break  # time limit exceeded
 
-    return output
+def rank_in_group(scores, groups):
+    # Returns the rank of each score within its group, 0 for the highest
+    i = scores.argsort(descending=True)
+    i = i[groups[i].sort(stable=True)[1]]  # by group, then by descending score
+    g = groups[i]
+    rank = torch.empty_like(i)
+    rank[i] = torch.arange(len(i), device=i.device) - torch.searchsorted(g, g)
+    return rank
+
+
+def merge_boxes(boxes, scores, groups, i, iou_thres, max_elements=1 << 22):
+    # Returns the score weighted mean of the same group boxes with IoU > iou_thres, for each box i
+    # Boxes i are taken in group order and compared to their groups only, max_elements iou values at a time
+    gi, k = groups[i].sort()  # groups of boxes i
+    o = groups.argsort()
+    b, s, g = boxes[o], scores[o], groups[o]  # all boxes sorted by group
+    start = torch.searchsorted(g, gi).tolist()
+    end = torch.searchsorted(g, gi, right=True).tolist()
+    bi = boxes[i[k]]
+    merged = torch.empty_like(bi)
+    r0 = 0
+    while r0 < len(bi):  # blocks of rows r0:r1 against columns c0:c1, small groups share a block
+        r1 = r0 + 1
+        while r1 < len(bi):
+            n = (r1 + 1 - r0) * (end[r1] - start[r0])  # block size with row r1
+            if n > max_elements or (start[r1] != start[r0] and n > 1 << 16):
+                break
+            r1 += 1
+        c0, c1 = start[r0], end[r1 - 1]
+        iou = box_iou(bi[r0:r1], b[c0:c1]) > iou_thres  # iou matrix
+        weights = (iou & (gi[r0:r1, None] == g[c0:c1])) * s[c0:c1]  # box weights, same group only
+        merged[k[r0:r1]] = torch.mm(weights, b[c0:c1]) / weights.sum(1, keepdim=True)  # merged boxes
+        r0 = r1
+
+    return merged
 
 
 def get_yolo_layers(model):
@@ -740,14 +842,16 @@ def create_backbone(f='weights/last.pt'):  # from utils.utils import *; create_b
 
 
 def coco_class_count(path='../coco/labels/train2014/'):
-    # Histogram of occurrences per class
+    # Histogram of occurrences per class, from a parallel scan of the label files
+    from utils.datasets import scan_labels, label_report
     nc = 80  # number classes
-    x = np.zeros(nc, dtype='int32')
     files = sorted(glob.glob('%s/*.*' % path))
-    for i, file in enumerate(files):
-        labels = np.loadtxt(file, dtype=np.float32).reshape(-1, 5)
-        x += np.bincount(labels[:, 0].astype('int32'), minlength=nc)
-        print(i, len(files))
+    labels, status, duplicate = scan_labels(files)
+    x = np.zeros(nc, dtype='int32')
+    c = label_report(labels, files, status, duplicate)['class_instances']
+    x[:len(c)] += c
+    print(x)
+    return x
 
 
 def coco_only_people(path='../coco/labels/train2017/'):  # from utils.utils import *; coco_only_people()